@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+""" Benchmark the particle filter offline across maps, particle counts and
+    beam counts.  A scenario is simulated in each map and the filter is run
+    over it with a fixed number of particles for every combination of the
+    swept parameters.
+
+    Example:
+        benchmark.py --particles 1000 5000 --beams 90 360 --csv results.csv
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+
+import numpy as np
+
+from harness import generate_scenario, run_scenario
+from map_loader import load_map
+from occupancy_field import OccupancyField
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'maps')
+COLUMNS = ['map', 'particles', 'beams', 'updates', 'updates_per_sec',
+           'laser_p50_ms', 'laser_p95_ms', 'laser_p99_ms',
+           'total_p50_ms', 'total_p95_ms', 'total_p99_ms',
+           'mean_position_error', 'mean_heading_error']
+
+
+def benchmark(map_yaml, particle_counts, beam_counts, steps=300, seed=0):
+    """ Yield a dictionary of results (with the keys in COLUMNS) for every
+        combination of particle_counts and beam_counts in the map """
+    field = OccupancyField(load_map(map_yaml))
+    beams = max(beam_counts)
+    scenario = generate_scenario(map_yaml, steps=steps, beams=beams,
+                                 seed=seed, field=field)
+    for particles in particle_counts:
+        for beam_count in beam_counts:
+            report = run_scenario(scenario,
+                                  field=field,
+                                  seed=seed,
+                                  n_particles=particles,
+                                  adaptive_particles=False,
+                                  laser_beam_stride=max(1, beams//beam_count))
+            laser = report.stage_times.percentiles("laser")
+            total = report.stage_times.percentiles("total")
+            yield dict(zip(COLUMNS, (
+                os.path.splitext(os.path.basename(map_yaml))[0],
+                particles,
+                beam_count,
+                report.updates,
+                report.updates_per_sec,
+                1000*laser[0], 1000*laser[1], 1000*laser[2],
+                1000*total[0], 1000*total[1], 1000*total[2],
+                np.mean(report.position_errors),
+                np.degrees(np.mean(report.heading_errors)))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--maps', nargs='+',
+                        default=sorted(glob.glob(os.path.join(MAPS_DIR,
+                                                              '*.yaml'))),
+                        help="map_server YAML files (default: all maps of "
+                             "the package)")
+    parser.add_argument('--particles', nargs='+', type=int,
+                        default=[500, 1000, 2000, 5000])
+    parser.add_argument('--beams', nargs='+', type=int,
+                        default=[45, 90, 180, 360])
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help="also write the results to this file")
+    args = parser.parse_args()
+
+    writer = None
+    if args.csv:
+        csv_file = open(args.csv, 'w')
+        writer = csv.DictWriter(csv_file, COLUMNS)
+        writer.writeheader()
+
+    print("%-10s %9s %6s %9s %9s %9s %9s" % ("map", "particles", "beams",
+                                            "upd/s", "laser p95",
+                                            "total p95", "pos err"))
+    for map_yaml in args.maps:
+        for row in benchmark(map_yaml, args.particles, args.beams,
+                             args.steps, args.seed):
+            print("%-10s %9d %6d %9.1f %9.2f %9.2f %9.3f" %
+                  (row['map'], row['particles'], row['beams'],
+                   row['updates_per_sec'], row['laser_p95_ms'],
+                   row['total_p95_ms'], row['mean_position_error']))
+            sys.stdout.flush()
+            if writer:
+                writer.writerow(row)
+    if writer:
+        csv_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+""" An offline harness that exercises the particle filter without ROS.  Maps
+    are loaded straight from the map_server YAML and image files, and laser
+    scans and odometry are either simulated in the map or replayed from a
+    scenario file.
+
+    Scenario files are numpy .npz archives containing:
+        map_yaml: the path of the map_server YAML file of the map
+        truth: (steps, 3) array of the true (x, y, theta) of the robot
+        odom: (steps, 3) array of the odometry (x, y, theta) of the robot
+        ranges: (steps, beams) array of the laser ranges
+        angle_min, angle_increment, range_min, range_max: the scan geometry
+        laser_pose: the (x, y, theta) of the laser relative to the robot base
+
+    Examples:
+        harness.py generate ../maps/ac109_1.yaml ac109_1.npz --steps 500
+        harness.py run ac109_1.npz --particles 2000 --beam-stride 2
+"""
+
+import argparse
+import collections
+import contextlib
+import math
+import os
+import time
+
+import numpy as np
+
+from localizer import Localizer
+from map_loader import load_map
+from occupancy_field import OccupancyField
+from recording import Recorder
+from ray_casting import cast_rays
+from se2 import compose, relative, wrap_angle, angle_diff
+
+Scenario = collections.namedtuple('Scenario',
+                                  ['map_yaml', 'truth', 'odom', 'ranges',
+                                   'angle_min', 'angle_increment',
+                                   'range_min', 'range_max', 'laser_pose'])
+
+
+def is_free(field, x, y, clearance=0.0):
+    """ Return True if (x, y) lies in a free cell of the map that is further
+        than clearance from the closest obstacle """
+    info = field.map.info
+    i = int(math.floor((x - info.origin.position.x)/info.resolution))
+    j = int(math.floor((y - info.origin.position.y)/info.resolution))
+    if not(0 <= i < info.width and 0 <= j < info.height):
+        return False
+    return field.grid[j, i] == 0 and field.closest_occ[j, i] > clearance
+
+
+def simulate_scans(field, poses, laser_pose, beams, range_max, noise, rng):
+    """ Return a (len(poses), beams) array of the ranges a 360 degree laser
+        mounted at laser_pose would measure from each pose.  Returns beyond
+        range_max are reported as 0 like the Neato's laser does. """
+    laser_x, laser_y, laser_theta = compose(np.asarray(poses).T, laser_pose)
+    angles = np.arange(beams)*2*math.pi/beams
+    ranges = cast_rays(field,
+                       laser_x[:, np.newaxis],
+                       laser_y[:, np.newaxis],
+                       laser_theta[:, np.newaxis] + angles,
+                       range_max)
+    ranges += rng.normal(0.0, noise, ranges.shape)
+    ranges[ranges >= range_max] = 0.0
+    return ranges.astype(np.float32)
+
+
+def generate_scenario(map_yaml, steps=500, beams=360, step_size=0.05,
+                      clearance=0.3, range_max=5.0, range_noise=0.01,
+                      odom_noise=(0.02, 0.01), laser_pose=(0.0, 0.0, 0.0),
+                      seed=None, field=None):
+    """ Simulate a robot wandering through the free space of a map.  The
+        robot drives straight in steps of step_size and turns in place
+        whenever it would leave free space or get closer than clearance to
+        an obstacle.
+        odom_noise gives the relative standard deviation of the odometry
+        translation and the standard deviation of the odometry rotation (in
+        radians) per step. """
+    rng = np.random.default_rng(seed)
+    if field is None:
+        field = OccupancyField(load_map(map_yaml))
+    info = field.map.info
+
+    rows, cols = np.nonzero((field.grid == 0) &
+                            (field.closest_occ > 2*clearance))
+    if not len(rows):
+        raise ValueError("%s has no free space with a clearance of %g m" %
+                         (map_yaml, 2*clearance))
+    start = rng.integers(len(rows))
+    pose = (info.origin.position.x + (cols[start] + 0.5)*info.resolution,
+            info.origin.position.y + (rows[start] + 0.5)*info.resolution,
+            rng.uniform(-math.pi, math.pi))
+    truth = [pose]
+    odom = [(0.0, 0.0, 0.0)]
+    for _ in range(steps - 1):
+        heading = pose[2] + rng.normal(0.0, 0.05)
+        candidate = (pose[0] + step_size*math.cos(heading),
+                     pose[1] + step_size*math.sin(heading),
+                     wrap_angle(heading))
+        if is_free(field, candidate[0], candidate[1], clearance):
+            new_pose = candidate
+        else:
+            turn = rng.uniform(math.pi/4, math.pi)*rng.choice((-1, 1))
+            new_pose = (pose[0], pose[1], wrap_angle(pose[2] + turn))
+        motion = tuple(relative(pose, new_pose))
+        noisy_motion = (motion[0]*(1 + rng.normal(0.0, odom_noise[0])),
+                        motion[1]*(1 + rng.normal(0.0, odom_noise[0])),
+                        motion[2] + rng.normal(0.0, odom_noise[1]))
+        odom.append(tuple(compose(odom[-1], noisy_motion)))
+        truth.append(new_pose)
+        pose = new_pose
+
+    ranges = simulate_scans(field, truth, laser_pose, beams, range_max,
+                            range_noise, rng)
+    return Scenario(map_yaml=os.path.abspath(map_yaml),
+                    truth=np.array(truth),
+                    odom=np.array(odom),
+                    ranges=ranges,
+                    angle_min=0.0,
+                    angle_increment=2*math.pi/beams,
+                    range_min=0.02,
+                    range_max=range_max,
+                    laser_pose=np.array(laser_pose, dtype=np.float64))
+
+
+def save_scenario(path, scenario):
+    """ Save scenario to the .npz file at path """
+    np.savez_compressed(path, **scenario._asdict())
+
+
+def load_scenario(path):
+    """ Load a scenario saved by save_scenario """
+    with np.load(path) as archive:
+        fields = dict((name, archive[name]) for name in Scenario._fields)
+    fields['map_yaml'] = str(fields['map_yaml'])
+    for name in ('angle_min', 'angle_increment', 'range_min', 'range_max'):
+        fields[name] = float(fields[name])
+    return Scenario(**fields)
+
+
+class StageTimes(object):
+    """ Collects the duration of every stage of the filter
+        Attributes:
+            samples: a dictionary from stage name to a list of durations
+            (seconds)
+    """
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """ Time the body of a with statement as one sample of stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def percentiles(self, stage, q=(50, 95, 99)):
+        """ Return the percentiles q of the durations of stage (seconds) """
+        samples = self.samples.get(stage)
+        if not samples:
+            return tuple(float('nan') for _ in q)
+        return tuple(np.percentile(samples, q))
+
+
+Report = collections.namedtuple('Report',
+                                ['updates', 'updates_per_sec', 'stage_times',
+                                 'position_errors', 'heading_errors',
+                                 'particle_counts'])
+
+
+def run_scenario(scenario, field=None, seed=None, record=None,
+                 global_start=False, kidnap=None, **params):
+    """ Run the filter over scenario and return a Report.  The filter starts
+        from a cloud around the true initial pose (or spread over the free
+        space of the map if global_start is set) and params are passed on to
+        the Localizer.  If record is given, the inputs of the filter are
+        recorded to that file (see recording.py).
+        kidnap is an optional (step, dx, dy): before that step the whole
+        cloud is shifted by (dx, dy), which leaves the filter confidently
+        wrong like a kidnapped robot, to test how it recovers. """
+    if record and kidnap:
+        raise ValueError("a kidnapped run cannot be recorded, shifting the "
+                         "cloud is not an input of the filter")
+    if field is None:
+        field = OccupancyField(load_map(scenario.map_yaml))
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    localizer = Localizer(field, seed=seed, **params)
+    laser_pose = tuple(scenario.laser_pose)
+    initial_pose = None if global_start else tuple(scenario.truth[0])
+    recorder = None
+    if record:
+        name = os.path.splitext(os.path.basename(scenario.map_yaml))[0]
+        recorder = Recorder(record, seed, params, {name: scenario.map_yaml})
+        recorder.map(0.0, name)
+        recorder.initial_pose(0.0, initial_pose)
+    localizer.initialize_particle_cloud(initial_pose)
+    localizer.update_pose_estimate()
+
+    stages = StageTimes()
+    position_errors = []
+    heading_errors = []
+    particle_counts = []
+    for step, (truth, odom, ranges) in enumerate(zip(scenario.truth,
+                                                     scenario.odom,
+                                                     scenario.ranges)):
+        if kidnap is not None and step == kidnap[0]:
+            localizer.particle_cloud.x += kidnap[1]
+            localizer.particle_cloud.y += kidnap[2]
+        if recorder is not None:
+            recorder.scan(float(step), tuple(odom), laser_pose, ranges,
+                          scenario.angle_min, scenario.angle_increment,
+                          scenario.range_min, scenario.range_max)
+        with stages.timer("total"):
+            updated = localizer.update(tuple(odom), ranges,
+                                       scenario.angle_min,
+                                       scenario.angle_increment,
+                                       laser_pose,
+                                       scenario.range_min,
+                                       scenario.range_max,
+                                       timer=stages.timer)
+        if not updated:
+            stages.samples["total"].pop()
+            continue
+        estimate = localizer.robot_xy_theta
+        position_errors.append(math.hypot(estimate[0] - truth[0],
+                                          estimate[1] - truth[1]))
+        heading_errors.append(abs(angle_diff(estimate[2], truth[2])))
+        particle_counts.append(len(localizer.particle_cloud))
+    if recorder is not None:
+        recorder.close()
+
+    busy = sum(stages.samples["total"])
+    updates = len(position_errors)
+    return Report(updates=updates,
+                  updates_per_sec=updates/busy if busy else float('nan'),
+                  stage_times=stages,
+                  position_errors=np.array(position_errors),
+                  heading_errors=np.array(heading_errors),
+                  particle_counts=np.array(particle_counts))
+
+
+def print_report(report):
+    """ Print a human readable summary of report """
+    print("updates: %d (%.1f updates/sec)" % (report.updates,
+                                              report.updates_per_sec))
+    print("%-10s %9s %9s %9s" % ("stage", "p50 ms", "p95 ms", "p99 ms"))
+    for stage in ("odom", "laser", "pose", "resample", "total"):
+        print("%-10s %9.2f %9.2f %9.2f" %
+              ((stage,) + tuple(1000*t for t in
+                                report.stage_times.percentiles(stage))))
+    if report.updates:
+        print("position error: mean %.3f m, median %.3f m, final %.3f m" %
+              (report.position_errors.mean(),
+               np.median(report.position_errors),
+               report.position_errors[-1]))
+        print("position error over the last 100 updates: median %.3f m" %
+              np.median(report.position_errors[-100:]))
+        print("heading error: mean %.1f deg, final %.1f deg" %
+              (math.degrees(report.heading_errors.mean()),
+               math.degrees(report.heading_errors[-1])))
+        print("particles: mean %.0f, final %d" %
+              (report.particle_counts.mean(), report.particle_counts[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generate = commands.add_parser('generate',
+                                   help="simulate a scenario in a map")
+    generate.add_argument('map_yaml')
+    generate.add_argument('output')
+    generate.add_argument('--steps', type=int, default=500)
+    generate.add_argument('--beams', type=int, default=360)
+    generate.add_argument('--seed', type=int)
+
+    run = commands.add_parser('run', help="run the filter over a scenario")
+    run.add_argument('scenario')
+    run.add_argument('--particles', type=int,
+                     help="use a fixed number of particles instead of "
+                          "KLD-sampling")
+    run.add_argument('--beam-stride', type=int, default=1)
+    run.add_argument('--model', choices=('likelihood_field', 'beam'),
+                     default='likelihood_field')
+    run.add_argument('--cache-resolution', type=float, nargs=3,
+                     metavar=('X', 'Y', 'DEGREES'),
+                     help="share the likelihood of particles within cells "
+                          "of this size")
+    run.add_argument('--workers', type=int, default=0,
+                     help="score large particle sets with this many worker "
+                          "processes")
+    run.add_argument('--global', dest='global_start', action='store_true',
+                     help="start from particles spread over the whole map")
+    run.add_argument('--recovery', type=float, nargs=2,
+                     metavar=('ALPHA_SLOW', 'ALPHA_FAST'),
+                     help="inject particles from free space when the fast "
+                          "average of the scan likelihood drops below the "
+                          "slow one")
+    run.add_argument('--kidnap', type=float, nargs=3,
+                     metavar=('STEP', 'DX', 'DY'),
+                     help="shift the particle cloud by DX, DY meters before "
+                          "STEP to test recovery (see --recovery)")
+    run.add_argument('--refine', type=int, default=0, metavar='K',
+                     help="align the K heaviest particles with every scan")
+    run.add_argument('--refine-estimate', action='store_true',
+                     help="align the pose estimate with every scan")
+    run.add_argument('--seed', type=int)
+    run.add_argument('--record', help="record the inputs of the filter to "
+                                      "this file for replay.py")
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        save_scenario(args.output,
+                      generate_scenario(args.map_yaml, steps=args.steps,
+                                        beams=args.beams, seed=args.seed))
+    else:
+        params = dict(laser_beam_stride=args.beam_stride,
+                      laser_model_type=args.model,
+                      laser_workers=args.workers,
+                      refine_particles=args.refine,
+                      refine_estimate=args.refine_estimate)
+        if args.cache_resolution:
+            x, y, degrees = args.cache_resolution
+            params.update(laser_cache_resolution=(x, y, math.radians(degrees)))
+        if args.recovery:
+            params.update(recovery_alpha_slow=args.recovery[0],
+                          recovery_alpha_fast=args.recovery[1])
+        if args.particles:
+            params.update(n_particles=args.particles,
+                          adaptive_particles=False)
+        print_report(run_scenario(load_scenario(args.scenario),
+                                  seed=args.seed, record=args.record,
+                                  global_start=args.global_start,
+                                  kidnap=args.kidnap and
+                                  (int(args.kidnap[0]),) +
+                                  tuple(args.kidnap[1:]),
+                                  **params))
+
+
+if __name__ == '__main__':
+    main()
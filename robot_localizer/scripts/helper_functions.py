@@ -6,11 +6,12 @@ import rospy
 from std_msgs.msg import Header
 from geometry_msgs.msg import PoseStamped, Pose, Point, Quaternion
 
-import tf.transformations as t
 from tf import TransformListener
 from tf import TransformBroadcaster
 
-import math
+import numpy as np
+
+import se2
 
 
 class TFHelper(object):
@@ -34,31 +35,36 @@ class TFHelper(object):
 
     def convert_pose_inverse_transform(self, pose):
         """ This is a helper method to invert a transform (this is built into
-            the tf C++ classes, but ommitted from Python) """
-        transform = t.concatenate_matrices(
-            t.translation_matrix([pose.position.x,
-                                  pose.position.y,
-                                  pose.position.z]),
-            t.quaternion_matrix([pose.orientation.x,
-                                 pose.orientation.y,
-                                 pose.orientation.z,
-                                 pose.orientation.w]))
-        inverse_transform_matrix = t.inverse_matrix(transform)
-        return (t.translation_from_matrix(inverse_transform_matrix),
-                t.quaternion_from_matrix(inverse_transform_matrix))
+            the tf C++ classes, but ommitted from Python).  The pose is
+            treated as planar (a translation and a yaw). """
+        x, y, theta = se2.inverse(self.convert_pose_to_xy_and_theta(pose))
+        return ((x, y, -pose.position.z),
+                tuple(se2.yaw_quaternions([theta])[0]))
 
     def convert_pose_to_xy_and_theta(self, pose):
         """ Convert pose (geometry_msgs.Pose) to a (x,y,yaw) tuple """
-        orientation_tuple = (pose.orientation.x,
-                             pose.orientation.y,
-                             pose.orientation.z,
-                             pose.orientation.w)
-        angles = t.euler_from_quaternion(orientation_tuple)
-        return (pose.position.x, pose.position.y, angles[2])
+        return (pose.position.x,
+                pose.position.y,
+                float(se2.yaw_from_quaternion(pose.orientation.x,
+                                              pose.orientation.y,
+                                              pose.orientation.z,
+                                              pose.orientation.w)))
+
+    def convert_xy_and_theta_to_poses(self, xs, ys, thetas):
+        """ Convert arrays of x, y and yaw (e.g. the rows of a particle
+            cloud) to a list of geometry_msgs/Pose messages, computing all of
+            the quaternions at once """
+        quaternions = se2.yaw_quaternions(thetas)
+        return [Pose(position=Point(x=x, y=y, z=0.0),
+                     orientation=Quaternion(x=0.0, y=0.0, z=qz, w=qw))
+                for x, y, qz, qw in zip(np.asarray(xs).tolist(),
+                                        np.asarray(ys).tolist(),
+                                        quaternions[:, 2].tolist(),
+                                        quaternions[:, 3].tolist())]
 
     def angle_normalize(self, z):
         """ convenience function to map an angle to the range [-pi,pi] """
-        return math.atan2(math.sin(z), math.cos(z))
+        return float(se2.wrap_angle(z))
 
     def angle_diff(self, a, b):
         """ Calculates the difference between angle a and angle b (both should
@@ -69,16 +75,7 @@ class TFHelper(object):
                 angle_diff(.1, 2*math.pi - .1) -> .2
                 angle_diff(.1, .2+2*math.pi) -> -.1
         """
-        a = self.angle_normalize(a)
-        b = self.angle_normalize(b)
-        d1 = a-b
-        d2 = 2*math.pi - math.fabs(d1)
-        if d1 > 0:
-            d2 *= -1.0
-        if math.fabs(d1) < math.fabs(d2):
-            return d1
-        else:
-            return d2
+        return float(se2.angle_diff(a, b))
 
     def fix_map_to_odom_transform(self, robot_pose, timestamp):
         """ This method constantly updates the offset of the map and
@@ -100,14 +97,19 @@ class TFHelper(object):
                                           timestamp,
                                           rospy.Duration(1.0))
         self.odom_to_map = self.tf_listener.transformPose('odom', p)
-        (self.translation, self.rotation) = \
+        # replace the translation and rotation with a single assignment so
+        # that another thread sending the transform never sees a mix of the
+        # old and the new transform
+        self.map_to_odom = \
             self.convert_pose_inverse_transform(self.odom_to_map.pose)
+        (self.translation, self.rotation) = self.map_to_odom
 
     def send_last_map_to_odom_transform(self):
-        if not(hasattr(self, 'translation') and hasattr(self, 'rotation')):
+        map_to_odom = getattr(self, 'map_to_odom', None)
+        if map_to_odom is None:
             return
-        self.tf_broadcaster.sendTransform(self.translation,
-                                          self.rotation,
+        self.tf_broadcaster.sendTransform(map_to_odom[0],
+                                          map_to_odom[1],
                                           rospy.get_rostime(),
                                           'odom',
                                           'map')
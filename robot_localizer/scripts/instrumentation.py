@@ -0,0 +1,170 @@
+""" Lightweight instrumentation for the filter loop.  Stage durations are
+    measured with a monotonic clock and kept in fixed size rolling windows,
+    so recording a sample costs a couple of microseconds and percentiles are
+    only computed when a snapshot is taken. """
+
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class RollingHistogram(object):
+    """ Keeps the most recent samples of a quantity in a ring buffer
+        Attributes:
+            samples: the ring buffer of samples
+            count: the total number of samples ever added
+    """
+
+    def __init__(self, size=1024):
+        self.samples = np.empty(size)
+        self.count = 0
+
+    def add(self, value):
+        """ Add a sample, replacing the oldest one once the buffer is full """
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def window(self):
+        """ Return the samples currently held by the buffer """
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def percentiles(self, q=(50, 95, 99)):
+        """ Return the percentiles q of the samples in the window (nan if
+            there are none) """
+        window = self.window()
+        if not len(window):
+            return tuple(float('nan') for _ in q)
+        return tuple(np.percentile(window, q))
+
+
+class _Timer(object):
+    """ Context manager that records the duration of its body """
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """ A thread safe registry of timers, counters and gauges
+        Attributes:
+            window: the number of recent samples kept for every timer
+            timers: a dictionary from name to the RollingHistogram of
+            durations (seconds)
+            counters: a dictionary from name to an event count
+            gauges: a dictionary from name to the last reported value
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name):
+        """ Return a context manager that records the duration of its body
+            (with a monotonic clock) as a sample of the timer name """
+        return _Timer(self, name)
+
+    def record(self, name, duration):
+        """ Add a duration (seconds) to the timer name """
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = RollingHistogram(self.window)
+            histogram.add(duration)
+
+    def count(self, name, n=1):
+        """ Increase the counter name by n """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        """ Set the gauge name to value """
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """ Return the current state of every metric as a dictionary with
+            the keys "timers" (name to count, p50, p95, p99 and max in
+            seconds), "counters" and "gauges" """
+        with self._lock:
+            windows = dict((name, (histogram.count, histogram.window().copy()))
+                           for name, histogram in self.timers.items())
+            counters = dict(self.counters)
+        gauges = dict(self.gauges)
+        timers = {}
+        for name, (count, window) in windows.items():
+            if len(window):
+                p50, p95, p99 = np.percentile(window, (50, 95, 99))
+                maximum = window.max()
+            else:
+                p50 = p95 = p99 = maximum = float('nan')
+            timers[name] = dict(count=count, p50=float(p50), p95=float(p95),
+                                p99=float(p99), max=float(maximum))
+        return dict(timers=timers, counters=counters, gauges=gauges)
+
+
+def flatten_snapshot(snapshot):
+    """ Return a snapshot as a flat dictionary with keys such as
+        "laser.p95", "scans_dropped" and "particles" """
+    flat = {}
+    for name, stats in sorted(snapshot['timers'].items()):
+        for key, value in sorted(stats.items()):
+            flat['%s.%s' % (name, key)] = value
+    flat.update(snapshot['counters'])
+    flat.update(snapshot['gauges'])
+    return flat
+
+
+class MetricsLog(object):
+    """ Appends snapshots of Metrics to a file, either as JSON lines (if the
+        path ends in .json or .jsonl) or as CSV.  A CSV log is in long format
+        with a (stamp, metric, value) row for every metric of a snapshot
+        (metric names as in flatten_snapshot), so metrics that first appear
+        after the log was started are recorded as well. """
+
+    CSV_COLUMNS = ['stamp', 'metric', 'value']
+
+    def __init__(self, path):
+        self.path = path
+        self.json = path.endswith('.json') or path.endswith('.jsonl')
+        self._file = open(path, 'a+')
+        self._writer = None
+        if not self.json:
+            self._file.seek(0)
+            header = self._file.readline().strip()
+            if header and header != ','.join(self.CSV_COLUMNS):
+                self._file.close()
+                raise ValueError("%s is not a metrics log with the columns "
+                                 "%s" % (path, ', '.join(self.CSV_COLUMNS)))
+            self._file.seek(0, 2)
+            self._writer = csv.writer(self._file)
+            if not header:
+                self._writer.writerow(self.CSV_COLUMNS)
+
+    def write(self, snapshot, stamp=None):
+        """ Append snapshot taken at stamp (seconds, defaults to now) """
+        stamp = time.time() if stamp is None else stamp
+        if self.json:
+            record = dict(snapshot, stamp=stamp)
+            self._file.write(json.dumps(record) + '\n')
+        else:
+            self._writer.writerows((stamp, name, value) for name, value in
+                                   sorted(flatten_snapshot(snapshot).items()))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,347 @@
+""" Measurement models that score laser scans against the map for every
+    particle in a single batched computation """
+
+import numpy as np
+
+from occupancy_field import lookup_distances
+
+
+class RangeFinderModel(object):
+    """ Functionality shared by the laser measurement models
+        Attributes:
+            beam_stride: only every beam_stride-th beam of a scan is used
+            max_range: beams that are longer than this are ignored (None to
+            only rely on the range_max of each scan)
+            chunk_size: the approximate number of particle-beam pairs that are
+            processed together, which bounds the size of temporary arrays
+    """
+
+    def __init__(self, beam_stride=1, max_range=None, chunk_size=1 << 18):
+        self.beam_stride = beam_stride
+        self.max_range = max_range
+        self.chunk_size = chunk_size
+        self._beam_tables = {}
+
+    def beam_table(self, angle_min, angle_increment, count):
+        """ Return the indices, cosines and sines of the beams that are used
+            from a scan with count beams starting at angle_min.  Tables are
+            cached since the scan geometry rarely changes. """
+        key = (angle_min, angle_increment, count, self.beam_stride)
+        table = self._beam_tables.get(key)
+        if table is None:
+            if len(self._beam_tables) > 16:
+                self._beam_tables.clear()
+            indices = np.arange(0, count, self.beam_stride)
+            angles = angle_min + indices*angle_increment
+            table = (indices, np.cos(angles), np.sin(angles))
+            self._beam_tables[key] = table
+        return table
+
+    def usable_beams(self, ranges, angle_min, angle_increment,
+                     range_min=0.0, range_max=float('inf')):
+        """ Return the number of beams of a scan that contribute to its
+            log likelihood (the arguments are described in
+            LikelihoodFieldModel.log_likelihoods), which by default are the
+            beams that have an endpoint (see scan_endpoints) """
+        return len(self.scan_endpoints(ranges, angle_min, angle_increment,
+                                       range_min=range_min,
+                                       range_max=range_max)[0])
+
+    def scan_endpoints(self, ranges, angle_min, angle_increment,
+                       laser_xy_theta=(0.0, 0.0, 0.0), range_min=0.0,
+                       range_max=float('inf')):
+        """ Return the x and y coordinates (in the robot base frame) of the
+            endpoints of the usable beams of a scan.  The laser is mounted at
+            laser_xy_theta relative to the robot base and beams that are not
+            finite, shorter than range_min, or at least as long as range_max
+            (or max_range) are dropped. """
+        ranges = np.asarray(ranges, dtype=np.float64)
+        indices, cos, sin = self.beam_table(angle_min, angle_increment,
+                                            len(ranges))
+        ranges = ranges[indices]
+        if self.max_range is not None:
+            range_max = min(range_max, self.max_range)
+        valid = np.isfinite(ranges) & (ranges > range_min) & \
+            (ranges < range_max)
+        ranges, cos, sin = ranges[valid], cos[valid], sin[valid]
+
+        laser_x, laser_y, laser_theta = laser_xy_theta
+        c, s = np.cos(laser_theta), np.sin(laser_theta)
+        xs = ranges*cos
+        ys = ranges*sin
+        return laser_x + c*xs - s*ys, laser_y + s*xs + c*ys
+
+    def chunks(self, n, beams):
+        """ Yield slices that split n particles into chunks of about
+            chunk_size particle-beam pairs """
+        rows = max(1, self.chunk_size//max(1, beams))
+        for start in range(0, n, rows):
+            yield slice(start, min(start + rows, n))
+
+
+class LikelihoodFieldModel(RangeFinderModel):
+    """ The likelihood field range finder model (Probabilistic Robotics,
+        table 6.3).  The endpoint of every beam is projected into the map for
+        every particle at once and scored by its distance to the closest
+        obstacle.  Since the score only depends on that distance, the log
+        likelihood of an endpoint landing in each cell is tabulated once per
+        map so the per-scan work is reduced to coordinate transforms, a table
+        lookup and a sum.
+        Attributes:
+            occupancy_field: the OccupancyField to score endpoints against
+            laser_max_distance: distances to the closest obstacle are clamped
+            to this value (it is also used for endpoints outside of the map)
+            sigma_hit: standard deviation of the measurement noise (meters)
+            z_hit: weight of the gaussian measurement noise component
+            z_rand: weight of the uniform random measurement component
+            interpolate: bilinearly interpolate the likelihood field
+            log_likelihood_field: the tabulated log likelihood of an endpoint
+            in each cell of the map
+            padded_field: log_likelihood_field surrounded by a one cell border
+            of misses, which lets endpoints be clipped into the table instead
+            of being bounds checked
+        See RangeFinderModel for the remaining attributes.
+    """
+
+    def __init__(self, occupancy_field, laser_max_distance=2.0,
+                 sigma_hit=0.1, z_hit=0.9, z_rand=0.1, beam_stride=1,
+                 max_range=None, interpolate=False, chunk_size=1 << 18):
+        super(LikelihoodFieldModel, self).__init__(beam_stride, max_range,
+                                                   chunk_size)
+        self.laser_max_distance = laser_max_distance
+        self.sigma_hit = sigma_hit
+        self.z_hit = z_hit
+        self.z_rand = z_rand
+        self.interpolate = interpolate
+        self.set_field(occupancy_field)
+
+    def endpoint_log_likelihood(self, distances):
+        """ Return the log likelihood of beam endpoints that lie the given
+            distances away from the closest obstacle """
+        distances = np.minimum(distances, self.laser_max_distance)
+        return np.log(self.z_hit*np.exp(-0.5*(distances/self.sigma_hit)**2) +
+                      self.z_rand)
+
+    def set_field(self, occupancy_field):
+        """ Score against occupancy_field from now on, tabulating its log
+            likelihood field """
+        self.occupancy_field = occupancy_field
+        self.log_likelihood_field = self.endpoint_log_likelihood(
+            occupancy_field.closest_occ).astype(np.float32)
+        self.miss_log_likelihood = float(
+            self.endpoint_log_likelihood(self.laser_max_distance))
+        self.padded_field = np.pad(self.log_likelihood_field, 1, 'constant',
+                                   constant_values=self.miss_log_likelihood)
+
+    def update_region(self, region):
+        """ Tabulate the log likelihood field again within region (a pair of
+            row and column slices of the map), after the distance field
+            changed there """
+        rows, cols = region
+        self.log_likelihood_field[region] = self.endpoint_log_likelihood(
+            self.occupancy_field.closest_occ[region])
+        self.padded_field[rows.start + 1:rows.stop + 1,
+                          cols.start + 1:cols.stop + 1] = \
+            self.log_likelihood_field[region]
+
+    def log_likelihoods(self, poses, ranges, angle_min, angle_increment,
+                        laser_xy_theta=(0.0, 0.0, 0.0), range_min=0.0,
+                        range_max=float('inf')):
+        """ Return the log likelihood of a scan for each pose.
+            poses: a (3, n) array (or triple of arrays) of x, y and theta
+            ranges, angle_min, angle_increment, range_min, range_max: the
+            corresponding fields of a sensor_msgs/LaserScan
+            laser_xy_theta: the pose of the laser relative to the robot base
+        """
+        beam_x, beam_y = self.scan_endpoints(ranges, angle_min,
+                                             angle_increment, laser_xy_theta,
+                                             range_min, range_max)
+        return self.endpoint_log_likelihoods(poses, beam_x, beam_y)
+
+    def endpoint_log_likelihoods(self, poses, beam_x, beam_y):
+        """ Return the summed log likelihood of the endpoints beam_x, beam_y
+            (in the robot base frame) for each pose in the (3, n) poses """
+        xs, ys, thetas = poses
+        n = len(xs)
+        log_likelihoods = np.zeros(n)
+        if not len(beam_x):
+            return log_likelihoods
+
+        info = self.occupancy_field.map.info
+        if self.interpolate:
+            for chunk in self.chunks(n, len(beam_x)):
+                c = np.cos(thetas[chunk])[:, np.newaxis]
+                s = np.sin(thetas[chunk])[:, np.newaxis]
+                map_x = xs[chunk, np.newaxis] + c*beam_x - s*beam_y
+                map_y = ys[chunk, np.newaxis] + s*beam_x + c*beam_y
+                endpoint = lookup_distances(
+                    self.log_likelihood_field,
+                    info.origin.position.x,
+                    info.origin.position.y,
+                    info.resolution,
+                    map_x, map_y,
+                    fill_value=self.miss_log_likelihood,
+                    interpolate=True)
+                log_likelihoods[chunk] = endpoint.sum(axis=1)
+            return log_likelihoods
+
+        # work in single precision grid units of the padded table, where the
+        # cell (i, j) of the map lives at [j + 1, i + 1]
+        height, width = self.padded_field.shape
+        beam_u = (np.asarray(beam_x)/info.resolution).astype(np.float32)
+        beam_v = (np.asarray(beam_y)/info.resolution).astype(np.float32)
+        us = ((xs - info.origin.position.x)/info.resolution + 1)
+        vs = ((ys - info.origin.position.y)/info.resolution + 1)
+        for chunk in self.chunks(n, len(beam_x)):
+            c = np.cos(thetas[chunk]).astype(np.float32)[:, np.newaxis]
+            s = np.sin(thetas[chunk]).astype(np.float32)[:, np.newaxis]
+            u = c*beam_u
+            u -= s*beam_v
+            u += us[chunk, np.newaxis].astype(np.float32)
+            v = s*beam_u
+            v += c*beam_v
+            v += vs[chunk, np.newaxis].astype(np.float32)
+            # everything outside of the map lands on the border of misses
+            np.clip(u, 0, width - 1, out=u)
+            np.clip(v, 0, height - 1, out=v)
+            index = v.astype(np.intp)
+            index *= width
+            index += u.astype(np.intp)
+            log_likelihoods[chunk] = \
+                self.padded_field.take(index).sum(axis=1, dtype=np.float64)
+        return log_likelihoods
+
+
+class BeamModel(RangeFinderModel):
+    """ The beam range finder model (Probabilistic Robotics, table 6.1).  The
+        range each beam should have measured from every particle is predicted
+        with a RayCaster and compared to the measured range using a mixture of
+        measurement noise, unexpected obstacles, max range readings and
+        random measurements.
+        Attributes:
+            ray_caster: the RayCaster that predicts the expected ranges
+            sigma_hit: standard deviation of the measurement noise (meters)
+            lambda_short: rate of the exponential distribution of readings
+            caused by unexpected obstacles
+            z_hit, z_short, z_max, z_rand: the weights of the four mixture
+            components
+            max_range: readings at least this long are treated as max range
+            readings (the ray caster's max_range is always an upper bound)
+        See RangeFinderModel for the remaining attributes.
+    """
+
+    def __init__(self, ray_caster, sigma_hit=0.2, lambda_short=0.5,
+                 z_hit=0.8, z_short=0.05, z_max=0.05, z_rand=0.1,
+                 beam_stride=1, max_range=None, chunk_size=1 << 18):
+        super(BeamModel, self).__init__(beam_stride, max_range, chunk_size)
+        self.ray_caster = ray_caster
+        self.sigma_hit = sigma_hit
+        self.lambda_short = lambda_short
+        self.z_hit = z_hit
+        self.z_short = z_short
+        self.z_max = z_max
+        self.z_rand = z_rand
+
+    def usable_beams(self, ranges, angle_min, angle_increment,
+                     range_min=0.0, range_max=float('inf')):
+        """ See RangeFinderModel.usable_beams """
+        ranges = np.asarray(ranges, dtype=np.float64)
+        indices, _, _ = self.beam_table(angle_min, angle_increment,
+                                        len(ranges))
+        ranges = ranges[indices]
+        return int(np.count_nonzero(np.isfinite(ranges) &
+                                    (ranges > range_min)))
+
+    def log_likelihoods(self, poses, ranges, angle_min, angle_increment,
+                        laser_xy_theta=(0.0, 0.0, 0.0), range_min=0.0,
+                        range_max=float('inf')):
+        """ Return the log likelihood of a scan for each pose.  The arguments
+            are the same as for LikelihoodFieldModel.log_likelihoods. """
+        xs, ys, thetas = poses
+        log_likelihoods = np.zeros(len(xs))
+
+        ranges = np.asarray(ranges, dtype=np.float64)
+        indices, _, _ = self.beam_table(angle_min, angle_increment,
+                                        len(ranges))
+        ranges = ranges[indices]
+        valid = np.isfinite(ranges) & (ranges > range_min)
+        ranges = ranges[valid]
+        if not len(ranges):
+            return log_likelihoods
+        angles = laser_xy_theta[2] + angle_min + \
+            indices[valid]*angle_increment
+
+        z_max = min(range_max, self.ray_caster.max_range)
+        if self.max_range is not None:
+            z_max = min(z_max, self.max_range)
+        is_max = ranges >= z_max
+        ranges = np.minimum(ranges, z_max)
+
+        laser_x, laser_y = laser_xy_theta[:2]
+        normalizer = 1.0/(self.sigma_hit*np.sqrt(2*np.pi))
+        for chunk in self.chunks(len(xs), len(ranges)):
+            c = np.cos(thetas[chunk])
+            s = np.sin(thetas[chunk])
+            origin_x = xs[chunk] + c*laser_x - s*laser_y
+            origin_y = ys[chunk] + s*laser_x + c*laser_y
+            expected = self.ray_caster.map_calc_range(
+                origin_x[:, np.newaxis],
+                origin_y[:, np.newaxis],
+                thetas[chunk, np.newaxis] + angles)
+            np.minimum(expected, z_max, out=expected)
+
+            p = self.z_hit*normalizer * \
+                np.exp(-0.5*((ranges - expected)/self.sigma_hit)**2)
+            p += np.where(ranges < expected,
+                          self.z_short*self.lambda_short *
+                          np.exp(-self.lambda_short*ranges),
+                          0.0)
+            p += np.where(is_max, self.z_max, self.z_rand/z_max)
+            log_likelihoods[chunk] = np.log(p).sum(axis=1)
+        return log_likelihoods
+
+
+class LikelihoodCache(object):
+    """ Shares the likelihood of a scan between particles whose poses fall in
+        the same (x, y, theta) cell, so that the (near) duplicates produced by
+        resampling are only scored once per scan.  Each cell is scored at the
+        pose of the first particle that falls into it.
+        Attributes:
+            resolution: the (x, y, theta) size of the cells (meters, meters,
+            radians)
+            hits: the number of particles that reused the likelihood of
+            another particle in their cell
+            misses: the number of cells that were scored
+    """
+
+    def __init__(self, resolution=(0.02, 0.02, np.radians(1.0))):
+        self.resolution = resolution
+        self.hits = 0
+        self.misses = 0
+
+    def cells(self, poses):
+        """ Return the index of the first pose in each occupied cell and the
+            cell of every pose (as an index into the former) """
+        xs, ys, thetas = poses
+        ix = np.floor(np.asarray(xs)/self.resolution[0]).astype(np.int64)
+        iy = np.floor(np.asarray(ys)/self.resolution[1]).astype(np.int64)
+        it = np.floor(np.asarray(thetas)/self.resolution[2]).astype(np.int64)
+        ix -= ix.min()
+        iy -= iy.min()
+        it -= it.min()
+        key = (ix*(iy.max() + 1) + iy)*(it.max() + 1) + it
+        _, first, inverse = np.unique(key, return_index=True,
+                                      return_inverse=True)
+        return first, inverse.ravel()
+
+    def log_likelihoods(self, score, poses):
+        """ Return score(poses) (the log likelihood of a scan for each of the
+            (3, n) poses) while only calling score for the first pose of each
+            cell """
+        poses = np.asarray(poses)
+        if not poses.shape[1]:
+            return score(poses)
+        first, inverse = self.cells(poses)
+        self.misses += len(first)
+        self.hits += poses.shape[1] - len(first)
+        return score(poses[:, first])[inverse]
@@ -0,0 +1,536 @@
+""" The particle filter update pipeline, independent of ROS.  The ROS node in
+    pf_scaffold.py and the offline harness both drive a Localizer. """
+
+import contextlib
+import math
+
+import numpy as np
+
+from particle_cloud import ParticleCloud
+from se2 import angle_diff
+import resampling
+from laser_model import LikelihoodFieldModel, BeamModel, LikelihoodCache
+from occupancy_field import DEFAULT_CACHE_DIR
+from ray_casting import RayCaster
+from pose_estimation import cluster_pose_estimate, weighted_pose_mean
+from scan_matching import ScanMatcher
+
+
+@contextlib.contextmanager
+def _untimed(stage):
+    yield
+
+
+class Localizer(object):
+    """ Maintains a particle cloud over the robot's pose in a map
+        Attributes:
+            occupancy_field: the OccupancyField of the map we are localizing
+            in
+            n_particles: the number of particles in the filter
+            d_thresh: the amount of linear movement before triggering a
+            filter update
+            a_thresh: the amount of angular movement before triggering a
+            filter update
+            laser_max_distance: the maximum distance to an obstacle we should
+            use in a likelihood calculation
+            laser_beam_stride: the stride between the beams of a scan that
+            are used in the likelihood calculation
+            laser_max_range: beams longer than this are ignored in the
+            likelihood calculation (None for no limit)
+            laser_model_type: "likelihood_field" or "beam" depending on which
+            measurement model to use
+            ray_cast_max_range: the longest range predicted by the ray
+            casting beam model
+            laser_cache_resolution: the (x, y, theta) cell size within which
+            particles share the likelihood of a scan (see
+            laser_model.LikelihoodCache), or None to score every particle
+            laser_workers: the number of worker processes that share the
+            evaluation of the likelihood field model for large particle sets
+            (0 to evaluate it in this process)
+            refine_particles: the number of heaviest particles that are
+            aligned with every scan by the ScanMatcher before they are
+            weighted (0 to leave the particles where the motion model put
+            them).  A refined particle is weighted by the likelihood of the
+            scan at its refined pose.
+            refine_estimate: whether the pose estimate is aligned with the
+            last scan as well
+            refine_iterations: the maximum number of Gauss-Newton steps of
+            each alignment
+            initial_sigma_xy: standard deviation of the initial cloud position
+            (meters)
+            initial_sigma_theta: standard deviation of the initial cloud yaw
+            (radians)
+            global_particles: the number of particles spread over the free
+            space of the map for global localization
+            odom_noise: the four alphas of the odometry motion model (see
+            ParticleCloud.apply_odometry)
+            resample_method: one of the keys of resampling.RESAMPLERS
+            resample_threshold: resample once the effective sample size drops
+            below this fraction of the particles
+            adaptive_particles: whether the number of particles is chosen by
+            KLD-sampling during resampling
+            kld_*: the parameters of KLD-sampling (see
+            resampling.kld_resample)
+            recovery_alpha_slow, recovery_alpha_fast: the rates of the slow
+            and fast running averages of the likelihood of a scan (taken per
+            beam, i.e. the geometric mean of the likelihoods of its beams, so
+            that scans of different lengths compare).  When the fast average
+            drops below the slow one, resampling replaces a fraction
+            1 - w_fast/w_slow of the particles by poses drawn from free space
+            (augmented MCL, Probabilistic Robotics, table 8.3), which lets
+            the filter recover from a wrong estimate or a kidnapped robot.
+            0 disables the injection; alpha_slow should be much smaller than
+            alpha_fast.
+            pose_estimator: "cluster" to estimate the pose from the heaviest
+            cluster of particles or "mean" for the mean of the whole cloud
+            cluster_cell_size: the (x, y, theta) size of the grid cells the
+            particles are clustered in
+            cluster_hysteresis: how much lighter than the heaviest cluster the
+            cluster of the previous estimate may be and still be used (see
+            pose_estimation.cluster_pose_estimate)
+            rng: the random number generator used by every stochastic step of
+            the filter
+            particle_cloud: a ParticleCloud representing a probability
+            distribution over robot poses
+            current_odom_xy_theta: the pose of the robot in the odometry frame
+            when the last filter update was performed, or None before the
+            first odometry is received
+            robot_xy_theta: the estimate of the robot's pose after the last
+            update (or None)
+            robot_covariance: the 3x3 covariance of x, y and theta of the
+            estimate (or None)
+            laser_model: the LikelihoodFieldModel or BeamModel used to weight
+            the particles
+            ray_caster: the RayCaster behind map_calc_range (created on first
+            use).  After update_map it is stale until a new table is passed
+            to install_ray_caster.
+            scan_matcher: the ScanMatcher used to refine poses (created on
+            first use)
+            last_scan_endpoints: the beam endpoints (in the robot base frame)
+            of the last scan, kept for refining the estimate
+            derived: a dictionary holding the laser models and ray casters
+            built for the current map (see set_map)
+            worker_pool: the parallel_laser.WorkerPool used if laser_workers
+            is set (created on first use)
+            likelihood_cache: the LikelihoodCache used if
+            laser_cache_resolution is set (it counts hits and misses)
+            w_slow, w_fast: the slow and fast averages of the scan likelihood
+            (None until the first scan after the cloud was initialized)
+            injected_particles: the number of particles drawn from free space
+            in the last resampling step
+    """
+
+    def __init__(self, occupancy_field, seed=None, derived=None, **params):
+        """ Create a localizer for occupancy_field (whose derived state is
+            cached in derived, see set_map).  seed initializes the random
+            number generator and any of the parameters listed above can be
+            overridden by keyword. """
+        self.occupancy_field = occupancy_field
+
+        self.n_particles = 300
+        self.d_thresh = 0.2
+        self.a_thresh = math.pi/6
+
+        self.laser_max_distance = 2.0
+        self.laser_beam_stride = 1
+        self.laser_max_range = None
+        self.laser_model_type = "likelihood_field"
+        self.ray_cast_max_range = 5.0
+        self.laser_cache_resolution = None
+        self.laser_workers = 0
+
+        self.refine_particles = 0
+        self.refine_estimate = False
+        self.refine_iterations = 3
+
+        self.initial_sigma_xy = 0.25
+        self.initial_sigma_theta = math.pi/8
+        self.global_particles = 5000
+        self.odom_noise = (0.1, 0.1, 0.1, 0.1)
+
+        self.resample_method = "systematic"
+        self.resample_threshold = 0.5
+
+        self.adaptive_particles = True
+        self.kld_min_particles = 100
+        self.kld_max_particles = 5000
+        self.kld_epsilon = 0.05
+        self.kld_z = 2.33
+        self.kld_bin_size = (0.2, 0.2, math.radians(10))
+
+        self.recovery_alpha_slow = 0.0
+        self.recovery_alpha_fast = 0.0
+
+        self.pose_estimator = "cluster"
+        self.cluster_cell_size = (0.5, 0.5, math.pi/6)
+        self.cluster_hysteresis = 0.2
+
+        for name, value in params.items():
+            if not hasattr(self, name):
+                raise TypeError("unknown localizer parameter %r" % name)
+            setattr(self, name, value)
+
+        self.rng = np.random.default_rng(seed)
+        self.current_odom_xy_theta = None
+        self.worker_pool = None
+        self.likelihood_cache = None
+        self.injected_particles = 0
+        if self.laser_cache_resolution:
+            self.likelihood_cache = LikelihoodCache(
+                self.laser_cache_resolution)
+        self.set_map(occupancy_field, derived)
+
+    def set_map(self, occupancy_field, derived=None):
+        """ Localize in occupancy_field from now on.  The particle cloud is
+            cleared, so it has to be initialized again in the new map.
+            derived is a dictionary that caches the laser model and ray caster
+            of the map; passing the same dictionary whenever switching back
+            to a map avoids rebuilding them. """
+        self.occupancy_field = occupancy_field
+        self.derived = {} if derived is None else derived
+        self.particle_cloud = ParticleCloud()
+        self.robot_xy_theta = None
+        self.robot_covariance = None
+        self.last_scan_endpoints = None
+        self.w_slow = None
+        self.w_fast = None
+        self._select_models()
+
+    def _select_models(self):
+        """ Pick the ray caster and laser model for the current map from
+            derived, building the laser model if there is none yet """
+        self.ray_caster = self.derived.get(('ray_caster',
+                                            self.ray_cast_max_range))
+        self.scan_matcher = self.derived.get(self._scan_matcher_key())
+        key = ('laser_model', self.laser_model_type, self.laser_max_distance,
+               self.laser_beam_stride, self.laser_max_range,
+               self.ray_cast_max_range, self.laser_workers)
+        self.laser_model = self.derived.get(key)
+        if self.laser_model is not None:
+            return
+        if self.laser_model_type == "beam":
+            self.laser_model = BeamModel(self.get_ray_caster(),
+                                         beam_stride=self.laser_beam_stride,
+                                         max_range=self.laser_max_range)
+        elif self.laser_workers:
+            # imported here since most configurations run in one process
+            from parallel_laser import SharedLikelihoodField, WorkerPool
+            if self.worker_pool is None:
+                self.worker_pool = WorkerPool(self.laser_workers)
+            self.laser_model = SharedLikelihoodField(
+                self.occupancy_field,
+                self.worker_pool,
+                laser_max_distance=self.laser_max_distance,
+                beam_stride=self.laser_beam_stride,
+                max_range=self.laser_max_range)
+        else:
+            self.laser_model = LikelihoodFieldModel(
+                self.occupancy_field,
+                laser_max_distance=self.laser_max_distance,
+                beam_stride=self.laser_beam_stride,
+                max_range=self.laser_max_range)
+        self.derived[key] = self.laser_model
+
+    def update_map(self, rows, cols, values, radius=None):
+        """ Change the occupancy values of the cells (rows, cols) of the
+            current map to values while localizing.  The distance field and
+            the likelihood field are only repaired around the changed cells
+            (see OccupancyField.update_cells), up to radius (which defaults
+            to laser_max_distance).  Ray casting tables cannot be repaired
+            locally.  Rebuilding one takes long, so the stale table (and the
+            beam model on it) stays in use until a table built by
+            build_ray_caster is installed with install_ray_caster. """
+        if radius is None:
+            radius = self.laser_max_distance
+        edits = self.occupancy_field.edits
+        regions = self.occupancy_field.update_cells(rows, cols, values,
+                                                    radius)
+        edited = self.occupancy_field.edits != edits
+        for key, value in list(self.derived.items()):
+            if hasattr(value, 'update_region'):
+                for region in regions:
+                    value.update_region(region)
+            elif edited and (key[0] == 'ray_caster' or
+                             isinstance(value, BeamModel)):
+                # switching back to this map builds them again
+                del self.derived[key]
+
+    def ray_caster_stale(self):
+        """ Return whether the ray casting table in use predates an edit of
+            the map """
+        return self.ray_caster is not None and \
+            self.ray_caster.edits != self.occupancy_field.edits
+
+    def build_ray_caster(self):
+        """ Return a new RayCaster for the current map.  The tables of edited
+            maps are not written to the on-disk cache, which would otherwise
+            gain a table with every edit.  Building only reads the map, so it
+            can run while another thread updates the filter (but not while
+            it edits the map). """
+        field = self.occupancy_field
+        return RayCaster(field, max_range=self.ray_cast_max_range,
+                         cache_dir=None if field.edits else DEFAULT_CACHE_DIR)
+
+    def install_ray_caster(self, ray_caster):
+        """ Use ray_caster (from build_ray_caster) and a beam model on it
+            from now on, unless the map was switched or edited after it was
+            built.  Returns whether ray_caster was installed. """
+        if ray_caster.occupancy_field is not self.occupancy_field or \
+                ray_caster.edits != self.occupancy_field.edits:
+            return False
+        self.derived[('ray_caster', self.ray_cast_max_range)] = ray_caster
+        self._select_models()
+        return True
+
+    def _scan_matcher_key(self):
+        return ('scan_matcher', self.laser_max_distance,
+                self.laser_beam_stride, self.laser_max_range)
+
+    def get_scan_matcher(self):
+        """ Return the ScanMatcher for the current map, tabulating the
+            gradient of its distance field the first time it is needed """
+        if self.scan_matcher is None:
+            self.scan_matcher = ScanMatcher(self.occupancy_field,
+                                            self.laser_max_distance,
+                                            beam_stride=self.laser_beam_stride,
+                                            max_range=self.laser_max_range)
+            self.derived[self._scan_matcher_key()] = self.scan_matcher
+        return self.scan_matcher
+
+    def get_ray_caster(self):
+        """ Return the RayCaster for the current map, building (or loading)
+            its table of expected ranges the first time it is needed """
+        if self.ray_caster is None:
+            self.ray_caster = self.build_ray_caster()
+            self.derived[('ray_caster', self.ray_cast_max_range)] = \
+                self.ray_caster
+        return self.ray_caster
+
+    def map_calc_range(self, x, y, theta):
+        """ Return the range a laser beam starting at (x,y) pointing in the
+            direction theta should measure given the map.  x, y and theta can
+            be arrays of any broadcastable shape, for instance a column of
+            particle poses against a row of beam angles. """
+        return self.get_ray_caster().map_calc_range(x, y, theta)
+
+    def initialize_particle_cloud(self, xy_theta=None):
+        """ Initialize the particle cloud around the triple xy_theta, or
+            spread global_particles particles uniformly over the free space
+            of the map if xy_theta is None (global localization) """
+        if xy_theta is None:
+            self.particle_cloud = ParticleCloud(
+                *self.occupancy_field.sample_free_poses(self.global_particles,
+                                                        self.rng))
+        else:
+            self.particle_cloud = ParticleCloud.from_gaussian(
+                self.n_particles,
+                xy_theta,
+                self.initial_sigma_xy,
+                self.initial_sigma_theta,
+                self.rng)
+        self.last_scan_endpoints = None
+        self.w_slow = None
+        self.w_fast = None
+        self.normalize_particles()
+
+    def normalize_particles(self):
+        """ Make sure the particle weights define a valid distribution (i.e.
+            sum to 1.0) """
+        self.particle_cloud.normalize()
+
+    def moved_enough(self, new_odom_xy_theta):
+        """ Return True if the odometry has moved far enough since the last
+            update to warrant a new one """
+        old = self.current_odom_xy_theta
+        return (math.fabs(new_odom_xy_theta[0] - old[0]) > self.d_thresh or
+                math.fabs(new_odom_xy_theta[1] - old[1]) > self.d_thresh or
+                math.fabs(angle_diff(new_odom_xy_theta[2], old[2])) >
+                self.a_thresh)
+
+    def update_particles_with_odom(self, new_odom_xy_theta):
+        """ Move the particles by the change in odometry since the last
+            update """
+        if self.current_odom_xy_theta is None:
+            self.current_odom_xy_theta = new_odom_xy_theta
+            return
+        old_odom_xy_theta = self.current_odom_xy_theta
+        self.current_odom_xy_theta = new_odom_xy_theta
+
+        # move every particle by the (noisy) change in odometry at once
+        self.particle_cloud.apply_odometry(old_odom_xy_theta,
+                                           new_odom_xy_theta,
+                                           self.odom_noise,
+                                           self.rng)
+
+    def update_particles_with_laser(self, ranges, angle_min, angle_increment,
+                                    laser_xy_theta=(0.0, 0.0, 0.0),
+                                    range_min=0.0, range_max=float('inf')):
+        """ Update the particle weights given a scan (the arguments are
+            described in LikelihoodFieldModel.log_likelihoods) """
+        def score(poses):
+            return self.laser_model.log_likelihoods(poses,
+                                                    ranges,
+                                                    angle_min,
+                                                    angle_increment,
+                                                    laser_xy_theta,
+                                                    range_min,
+                                                    range_max)
+        if self.likelihood_cache is None:
+            log_likelihoods = score(self.particle_cloud.poses)
+        else:
+            log_likelihoods = self.likelihood_cache.log_likelihoods(
+                score, self.particle_cloud.poses)
+        if self.refine_particles or self.refine_estimate:
+            self.last_scan_endpoints = self.get_scan_matcher().scan_endpoints(
+                ranges, angle_min, angle_increment, laser_xy_theta, range_min,
+                range_max)
+        if self.refine_particles:
+            self._refine_particles(log_likelihoods, score)
+        if self.recovery_alpha_slow:
+            beams = self.laser_model.usable_beams(ranges, angle_min,
+                                                  angle_increment, range_min,
+                                                  range_max)
+            self._update_likelihood_averages(log_likelihoods, beams)
+        self.particle_cloud.reweight(log_likelihoods)
+
+    def _refine_particles(self, log_likelihoods, score):
+        """ Align the refine_particles particles that are heaviest after
+            weighting by log_likelihoods with the last scan and replace their
+            log likelihoods by those at the refined poses (given by score) """
+        cloud = self.particle_cloud
+        k = min(self.refine_particles, len(cloud))
+        if not k:
+            return
+        with np.errstate(divide='ignore'):
+            log_w = np.log(cloud.w) + log_likelihoods
+        top = np.argpartition(log_w, len(cloud) - k)[len(cloud) - k:]
+        refined, _ = self.scan_matcher.refine_endpoints(
+            cloud.poses[:, top], self.last_scan_endpoints[0],
+            self.last_scan_endpoints[1], self.refine_iterations)
+        cloud.poses[:, top] = refined
+        log_likelihoods[top] = score(refined)
+
+    def _update_likelihood_averages(self, log_likelihoods, beams):
+        """ Fold the weighted mean over the particles of the per beam
+            likelihood of a scan of beams beams, whose log likelihoods are
+            given for every particle, into w_slow and w_fast """
+        if not beams:
+            return
+        w = self.particle_cloud.w
+        mean = np.dot(w, np.exp(log_likelihoods/beams))/w.sum()
+        if not np.isfinite(mean):
+            return
+        if self.w_slow is None:
+            self.w_slow = self.w_fast = mean
+            return
+        self.w_slow += self.recovery_alpha_slow*(mean - self.w_slow)
+        self.w_fast += self.recovery_alpha_fast*(mean - self.w_fast)
+
+    def injection_probability(self):
+        """ Return the probability with which resampling replaces a
+            particle by a pose drawn from free space (max(0, 1 -
+            w_fast/w_slow), or 0 if recovery is disabled) """
+        if not self.recovery_alpha_slow or self.w_slow is None:
+            return 0.0
+        return max(0.0, 1.0 - self.w_fast/self.w_slow)
+
+    def estimate_pose(self):
+        """ Return the estimated (x, y, theta) of the robot and its 3x3
+            covariance, computed by the pose_estimator (and aligned with the
+            last scan if refine_estimate is set) """
+        self.normalize_particles()
+        cloud = self.particle_cloud
+        if self.pose_estimator == "mean":
+            pose, covariance = weighted_pose_mean(cloud.x, cloud.y,
+                                                  cloud.theta, cloud.w)
+        else:
+            pose, covariance, _ = cluster_pose_estimate(
+                cloud.x, cloud.y, cloud.theta, cloud.w,
+                self.cluster_cell_size, self.robot_xy_theta,
+                self.cluster_hysteresis)
+        if self.refine_estimate and self.last_scan_endpoints is not None:
+            refined, _ = self.get_scan_matcher().refine_endpoints(
+                pose, self.last_scan_endpoints[0],
+                self.last_scan_endpoints[1], self.refine_iterations)
+            pose = tuple(float(value) for value in refined[:, 0])
+        return pose, covariance
+
+    def update_pose_estimate(self):
+        """ Update robot_xy_theta and robot_covariance from the particles and
+            return the new estimate """
+        self.robot_xy_theta, self.robot_covariance = self.estimate_pose()
+        return self.robot_xy_theta
+
+    def resample_particles(self):
+        """ Resample the particles according to the new particle weights.
+            Resampling is skipped while the effective sample size shows that
+            the weights are still well spread out.  Returns True if the
+            particles were resampled. """
+        # make sure the distribution is normalized
+        self.normalize_particles()
+        weights = self.particle_cloud.w
+        if resampling.effective_sample_size(weights) >= \
+                self.resample_threshold*len(weights):
+            return False
+        injection = self.injection_probability()
+        injected = 0
+        if self.adaptive_particles:
+            cloud = self.particle_cloud
+            bins = resampling.histogram_bins(cloud.x, cloud.y, cloud.theta,
+                                             self.kld_bin_size)
+            indices = resampling.kld_resample(weights,
+                                              bins,
+                                              self.kld_min_particles,
+                                              self.kld_max_particles,
+                                              self.kld_epsilon,
+                                              self.kld_z,
+                                              self.resample_method,
+                                              self.rng)
+            self.n_particles = len(indices)
+            if injection > 0:
+                # the candidates are in random order, so any of them can go
+                injected = self.rng.binomial(len(indices), injection)
+                indices = indices[:len(indices) - injected]
+        else:
+            if injection > 0:
+                injected = self.rng.binomial(self.n_particles, injection)
+            indices = resampling.resample(weights,
+                                          self.n_particles - injected,
+                                          self.resample_method,
+                                          self.rng)
+        extra_poses = None
+        if injected:
+            # the averages carry on (Probabilistic Robotics, table 8.3), so
+            # injection continues for as long as the scans fit the cloud
+            # worse than they used to
+            extra_poses = self.occupancy_field.sample_free_poses(injected,
+                                                                 self.rng)
+        self.injected_particles = injected
+        self.particle_cloud.resample(indices, extra_poses)
+        return True
+
+    def update(self, odom_xy_theta, ranges, angle_min, angle_increment,
+               laser_xy_theta=(0.0, 0.0, 0.0), range_min=0.0,
+               range_max=float('inf'), timer=_untimed):
+        """ Run one step of the filter given the odometry pose and the scan
+            taken at the same time.  The particles are only updated once the
+            robot has moved far enough since the last update.  timer is
+            called with the name of each stage ("odom", "laser", "pose" and
+            "resample") and must return a context manager that is active
+            while the stage runs.  Returns True if the filter was updated. """
+        if self.current_odom_xy_theta is None:
+            self.current_odom_xy_theta = odom_xy_theta
+            return False
+        if not self.particle_cloud or not self.moved_enough(odom_xy_theta):
+            return False
+        with timer("odom"):
+            self.update_particles_with_odom(odom_xy_theta)
+        with timer("laser"):
+            self.update_particles_with_laser(ranges, angle_min,
+                                             angle_increment, laser_xy_theta,
+                                             range_min, range_max)
+        with timer("pose"):
+            self.update_pose_estimate()
+        with timer("resample"):
+            self.resample_particles()
+        return True
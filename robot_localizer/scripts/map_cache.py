@@ -0,0 +1,174 @@
+""" An in-process least recently used cache of the occupancy fields of several
+    named maps, so a node can switch between maps without rebuilding their
+    distance fields.  Maps that are evicted to stay within the memory budget
+    are restored from the on-disk distance field cache when they are needed
+    again. """
+
+import collections
+import logging
+import os
+import threading
+
+import numpy as np
+
+from map_loader import load_map
+from occupancy_field import OccupancyField, DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+
+def _nbytes(obj):
+    """ Return the number of bytes of memory held by obj if it is an array,
+        or by the array attributes of obj otherwise.  Memory-mapped arrays are
+        backed by files and are not counted. """
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return sum(value.nbytes for value in vars(obj).values()
+               if isinstance(value, np.ndarray) and
+               not isinstance(value, np.memmap))
+
+
+class MapEntry(object):
+    """ A map held by a MapCache
+        Attributes:
+            name: the name of the map
+            map_file: the map_server YAML file the map was loaded from
+            field: the OccupancyField of the map
+            derived: a dictionary in which users of the map can keep state
+            derived from it (such as measurement model tables).  It lives and
+            is evicted together with the field.
+    """
+
+    def __init__(self, name, map_file, field):
+        self.name = name
+        self.map_file = map_file
+        self.field = field
+        self.derived = {}
+
+    @property
+    def nbytes(self):
+        """ The memory held by the field and the derived state (bytes) """
+        return (_nbytes(self.field.grid) + _nbytes(self.field.closest_occ) +
+                _nbytes(self.field.free_cells) +
+                # the filter may add to derived while another thread trims
+                sum(_nbytes(value) for value in list(self.derived.values())))
+
+
+class MapCache(object):
+    """ Loads maps by name and keeps the most recently used ones in memory.
+        The cache may be used from several threads (e.g. preloading maps in
+        the background while the node switches maps); a map requested while
+        another thread is loading it is only loaded once.
+        Attributes:
+            map_files: a dictionary from map name to map_server YAML file
+            memory_budget: the cache evicts the least recently used maps
+            while it holds more than this many bytes (the map that was
+            requested last and the pinned map are always kept)
+            cache_dir: the directory of the on-disk distance field cache
+            pinned: the name of a map that is never evicted, such as the map
+            a filter is localizing in (None for no map)
+    """
+
+    def __init__(self, map_files=(), memory_budget=256 << 20,
+                 cache_dir=DEFAULT_CACHE_DIR):
+        """ map_files is either a dictionary from name to map_server YAML
+            file or a list of YAML files named after their file names """
+        self.map_files = {}
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.pinned = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        if isinstance(map_files, dict):
+            for name, map_file in map_files.items():
+                self.add(map_file, name)
+        else:
+            for map_file in map_files:
+                self.add(map_file)
+
+    def add(self, map_file, name=None):
+        """ Register the map described by map_file under name (which defaults
+            to the YAML file name without extension) and return the name """
+        if name is None:
+            name = os.path.splitext(os.path.basename(map_file))[0]
+        with self._lock:
+            if self.map_files.get(name, map_file) != map_file:
+                self.evict(name)
+            self.map_files[name] = map_file
+        return name
+
+    def names(self):
+        """ Return the sorted names of the registered maps """
+        with self._lock:
+            return sorted(self.map_files)
+
+    def __contains__(self, name):
+        return name in self.map_files
+
+    def loaded(self):
+        """ Return the names of the maps held in memory, least recently used
+            first """
+        with self._lock:
+            return list(self._entries)
+
+    @property
+    def nbytes(self):
+        """ The memory held by the cached maps (bytes) """
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def get(self, name):
+        """ Return the MapEntry of the named map, loading it (and restoring
+            its distance field from the on-disk cache if possible) if it is
+            not in memory.  Raises KeyError for an unknown name. """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+            else:
+                map_file = self.map_files[name]
+                logger.info("loading map %s from %s", name, map_file)
+                field = OccupancyField(load_map(map_file),
+                                       cache_dir=self.cache_dir)
+                entry = self._entries[name] = MapEntry(name, map_file, field)
+            self.trim()
+            return entry
+
+    def preload(self, names=None):
+        """ Load the named maps (all of the registered maps by default) into
+            memory, as far as the memory budget allows """
+        for name in self.names() if names is None else names:
+            self.get(name)
+
+    def remove(self, name):
+        """ Forget the named map """
+        with self._lock:
+            self.map_files.pop(name, None)
+            self._entries.pop(name, None)
+
+    def evict(self, name):
+        """ Drop the named map from memory """
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def pin(self, name):
+        """ Never evict the named map (and no longer the one pinned before).
+            Its field stays in use as long as a filter localizes in it, so
+            evicting it would not free any memory. """
+        with self._lock:
+            self.pinned = name
+
+    def trim(self):
+        """ Evict the least recently used maps until the cache fits in its
+            memory budget """
+        with self._lock:
+            total = self.nbytes
+            for name in list(self._entries)[:-1]:
+                if total <= self.memory_budget:
+                    break
+                if name == self.pinned:
+                    continue
+                total -= self._entries.pop(name).nbytes
+                logger.info("evicted map %s from the map cache", name)
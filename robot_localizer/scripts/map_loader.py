@@ -0,0 +1,163 @@
+""" Load maps saved by map_server (a YAML description plus a PGM image)
+    directly from disk, without going through ROS.  The image is memory-mapped
+    and converted to occupancy values with a lookup table, so loading a map
+    neither waits for map_server nor copies the map through a python list. """
+
+import logging
+import os
+
+import numpy as np
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# the errors raised by load_map for a missing or malformed map
+LOAD_ERRORS = (IOError, OSError, ValueError, KeyError, yaml.YAMLError)
+
+
+class Point(object):
+    """ A 3D point with the fields of geometry_msgs/Point """
+
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Origin(object):
+    """ The pose of the lower left cell of a map.  Only the position field of
+        geometry_msgs/Pose is provided (yaw is kept as a plain angle). """
+
+    def __init__(self, x=0.0, y=0.0, yaw=0.0):
+        self.position = Point(x, y)
+        self.yaw = yaw
+
+
+class MapInfo(object):
+    """ The fields of nav_msgs/MapMetaData used by the localizer """
+
+    def __init__(self, resolution, width, height, origin):
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+        self.origin = origin
+
+
+class GridMap(object):
+    """ A stand-in for nav_msgs/OccupancyGrid whose data is a flat int8 numpy
+        array (row major, starting at the lower left cell) with values 0
+        (free), 100 (occupied) or -1 (unknown)
+        Attributes:
+            info: the MapInfo of the map
+            data: the occupancy of every cell
+            name: the name of the map (the YAML file name without extension)
+    """
+
+    def __init__(self, info, data, name=None):
+        self.info = info
+        self.data = data
+        self.name = name
+
+
+def read_pnm(path):
+    """ Memory-map a binary PGM (P5) or PPM (P6) image with 8 bits per
+        channel and return it as a read-only array of shape (rows, columns,
+        channels) """
+    with open(path, 'rb') as f:
+        magic = f.readline().strip()
+        if magic not in (b'P5', b'P6'):
+            raise ValueError("%s is not a binary PGM or PPM image" % path)
+        fields = []
+        while len(fields) < 3:
+            line = f.readline()
+            if not line:
+                raise ValueError("truncated header in %s" % path)
+            fields.extend(line.split(b'#', 1)[0].split())
+        width, height, max_value = (int(field) for field in fields)
+        if max_value > 255:
+            raise ValueError("%s uses more than 8 bits per channel" % path)
+        channels = 1 if magic == b'P5' else 3
+        offset = f.tell()
+    if os.path.getsize(path) < offset + width*height*channels:
+        raise ValueError("truncated image data in %s" % path)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset,
+                     shape=(height, width, channels))
+
+
+def occupancy_table(channels, occupied_thresh, free_thresh, negate=False,
+                    mode='trinary'):
+    """ Return a lookup table from the sum of the channels of a pixel to its
+        occupancy value, following the interpretation of map_server:
+            trinary: 100 (occupied), 0 (free) or -1 (unknown)
+            scale: like trinary, but unknown pixels are scaled linearly
+            between the thresholds to values in [0, 99]
+            raw: the (averaged) pixel value itself
+        Darker pixels are more likely to be occupied unless negate is set. """
+    value = np.arange(255*channels + 1)/float(channels)
+    if negate:
+        # map_server negates the pixel value before any of the modes
+        value = 255.0 - value
+    if mode == 'raw':
+        return np.rint(value).astype(np.int16).astype(np.int8)
+    occupancy = 1.0 - value/255.0
+    if mode == 'trinary':
+        table = np.full(occupancy.shape, -1, dtype=np.int8)
+    elif mode == 'scale':
+        table = np.rint(99*(occupancy - free_thresh) /
+                        (occupied_thresh - free_thresh)).astype(np.int8)
+    else:
+        raise ValueError("unknown map mode %r" % mode)
+    table[occupancy > occupied_thresh] = 100
+    table[occupancy < free_thresh] = 0
+    return table
+
+
+def occupancy_from_image(image, occupied_thresh, free_thresh, negate=False,
+                         mode='trinary'):
+    """ Convert image (rows, columns, channels) to a (rows, columns) array of
+        occupancy values (see occupancy_table) whose first row is the bottom
+        of the map """
+    channels = image.shape[2]
+    table = occupancy_table(channels, occupied_thresh, free_thresh, negate,
+                            mode)
+    # the first row of the image is the top of the map
+    image = image[::-1]
+    if channels == 1:
+        return table[image[:, :, 0]]
+    return table[image.sum(axis=2, dtype=np.uint16)]
+
+
+def load_map(yaml_path):
+    """ Load the map described by the map_server YAML file at yaml_path and
+        return it as a GridMap """
+    with open(yaml_path) as f:
+        description = yaml.safe_load(f)
+    image_path = os.path.join(os.path.dirname(os.path.abspath(yaml_path)),
+                              description['image'])
+    grid = occupancy_from_image(read_pnm(image_path),
+                                description['occupied_thresh'],
+                                description['free_thresh'],
+                                bool(description.get('negate', 0)),
+                                description.get('mode', 'trinary'))
+    origin = description['origin']
+    info = MapInfo(resolution=float(description['resolution']),
+                   width=grid.shape[1],
+                   height=grid.shape[0],
+                   origin=Origin(*origin))
+    name = os.path.splitext(os.path.basename(yaml_path))[0]
+    return GridMap(info, grid.ravel(), name)
+
+
+def get_map(map_file=None):
+    """ Return the map described by the map_server YAML file map_file.  If
+        map_file is not given or cannot be loaded, fall back to requesting
+        the map from the map server's static_map service. """
+    if map_file:
+        try:
+            return load_map(map_file)
+        except LOAD_ERRORS as e:
+            logger.warning("unable to load map %s (%s), waiting for the "
+                           "static_map service instead", map_file, e)
+    # imported here to keep this module free of ROS dependencies
+    from occupancy_field import fetch_static_map
+    return fetch_static_map()
@@ -1,86 +1,310 @@
 """ An implementation of an occupancy field that you can use to implement
     your particle filter """
 
-import rospy
+import hashlib
+import logging
+import math
+import os
+import struct
 
-from nav_msgs.srv import GetMap
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+
+import resampling
+
+# bump this whenever the on-disk layout of the distance field changes so that
+# stale cache entries are never picked up
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ros',
+                                 'occupancy_field_cache')
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_static_map():
+    """ Block until the map server's static_map service is available and
+        return the map it serves (nav_msgs/OccupancyGrid) """
+    # ROS is only needed when the map comes from the map server, which keeps
+    # this module usable offline
+    import rospy
+    from nav_msgs.srv import GetMap
+
+    rospy.wait_for_service("static_map")
+    static_map = rospy.ServiceProxy("static_map", GetMap)
+    return static_map().map
+
+
+def compute_distance_field(occupied, resolution):
+    """ Compute the exact Euclidean distance (in meters) from the center of
+        every cell in the boolean grid occupied to the center of the closest
+        occupied cell.  If the grid has no occupied cells every distance is
+        infinite. """
+    if not occupied.any():
+        return np.full(occupied.shape, np.inf, dtype=np.float32)
+    # scipy takes a while to import and is not needed when the field is cached
+    from scipy.ndimage import distance_transform_edt
+    distances = distance_transform_edt(~occupied)
+    return (distances*resolution).astype(np.float32)
+
+
+def map_hash(grid, resolution, origin_x, origin_y):
+    """ Return a hex digest that identifies the distance field computed from
+        the occupancy values in grid with the specified resolution and
+        origin """
+    digest = hashlib.sha1()
+    digest.update(struct.pack('<iiiddd', CACHE_VERSION,
+                              grid.shape[1], grid.shape[0],
+                              resolution, origin_x, origin_y))
+    digest.update(np.ascontiguousarray(grid, dtype=np.int8).tobytes())
+    return digest.hexdigest()
+
+
+def lookup_distances(closest_occ, origin_x, origin_y, resolution, xs, ys,
+                     fill_value=float('nan'), interpolate=False):
+    """ Look up the distance field closest_occ (indexed [y, x] with the
+        specified origin and resolution) at the coordinates xs and ys, which
+        can be arrays of any (matching or broadcastable) shape.  The result has
+        the broadcast shape of the inputs and contains fill_value wherever a
+        coordinate falls outside of the map.  If interpolate is True the field
+        is bilinearly interpolated between cell centers rather than read from
+        the cell containing each coordinate. """
+    xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.float64),
+                                 np.asarray(ys, dtype=np.float64))
+    height, width = closest_occ.shape
+    u = (xs - origin_x)/resolution
+    v = (ys - origin_y)/resolution
+    # comparisons against nan are False so nan coordinates are out of bounds
+    in_bounds = (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    u = np.where(in_bounds, u, 0.0)
+    v = np.where(in_bounds, v, 0.0)
+
+    if interpolate:
+        # samples of the field live at the cell centers
+        u -= 0.5
+        v -= 0.5
+        x0 = np.floor(u)
+        y0 = np.floor(v)
+        fx = u - x0
+        fy = v - y0
+        x0 = x0.astype(np.intp)
+        y0 = y0.astype(np.intp)
+        # within half a cell of the border we clamp to the edge values
+        x1 = np.clip(x0 + 1, 0, width - 1)
+        y1 = np.clip(y0 + 1, 0, height - 1)
+        x0 = np.clip(x0, 0, width - 1)
+        y0 = np.clip(y0, 0, height - 1)
+        distances = ((closest_occ[y0, x0]*(1 - fx) +
+                      closest_occ[y0, x1]*fx)*(1 - fy) +
+                     (closest_occ[y1, x0]*(1 - fx) +
+                      closest_occ[y1, x1]*fx)*fy)
+    else:
+        distances = closest_occ[v.astype(np.intp), u.astype(np.intp)]
+
+    return np.where(in_bounds, distances, fill_value)
 
 
 class OccupancyField(object):
     """ Stores an occupancy field for an input map.  An occupancy field returns
         the distance to the closest obstacle for any coordinate in the map
         Attributes:
-            map: the map to localize against (nav_msgs/OccupancyGrid)
-            closest_occ: the distance for each entry in the OccupancyGrid to
-            the closest obstacle
+            map: the map to localize against (nav_msgs/OccupancyGrid, or any
+            object with the same info and data fields such as the maps
+            returned by map_loader.load_map)
+            grid: the occupancy values of the map as a (height, width) array
+            closest_occ: the distance (in meters) from each cell of the map to
+            the closest obstacle as a (height, width) array indexed [y, x]
+            cache_dir: the directory used to persist distance fields between
+            runs (None disables the cache)
+            free_cells: the flat indices (into grid.ravel()) of the cells that
+            are known to be free, from which sample_free_poses draws
+            edits: the number of update_cells calls that changed the value of
+            a cell (0 until the field is first edited)
+            exact_radius: distances in closest_occ below this are exact, the
+            others are only known to be at least exact_radius (infinite until
+            update_cells repairs the field, see there)
     """
 
-    def __init__(self):
-        # grab the map from the map server
-        rospy.wait_for_service("static_map")
-        static_map = rospy.ServiceProxy("static_map", GetMap)
-        self.map = static_map().map
-
-        # The coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height, 2))
-
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr, 0] = float(i)
-                X[curr, 1] = float(j)
-                curr += 1
-
-        # The coordinates of each occupied grid cell in the map
-        occupied = np.zeros((total_occupied, 2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    occupied[curr, 0] = float(i)
-                    occupied[curr, 1] = float(j)
-                    curr += 1
-
-        # use super fast scikit learn nearest neighbor algorithm
-        nbrs = NearestNeighbors(n_neighbors=1,
-                                algorithm="ball_tree").fit(occupied)
-        distances, indices = nbrs.kneighbors(X)
-
-        self.closest_occ = {}
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                ind = i + j*self.map.info.width
-                self.closest_occ[ind] = \
-                    distances[curr][0]*self.map.info.resolution
-                curr += 1
+    def __init__(self, map=None, cache_dir=DEFAULT_CACHE_DIR):
+        """ Build the occupancy field for map.  If map is omitted it is
+            requested from the map server. """
+        if map is None:
+            map = fetch_static_map()
+        self.map = map
+        self.cache_dir = cache_dir
+
+        # occupancy grids are stored in row major order
+        self.grid = np.asarray(self.map.data, dtype=np.int8).reshape(
+            self.map.info.height, self.map.info.width)
+
+        self.closest_occ = self._load_or_compute_distance_field()
+        self.free_cells = np.flatnonzero(self.grid == 0)
+        self.edits = 0
+        self.exact_radius = float('inf')
+
+    def _cache_path(self):
+        """ Return the path of the cache file for the current map """
+        key = map_hash(self.grid,
+                       self.map.info.resolution,
+                       self.map.info.origin.position.x,
+                       self.map.info.origin.position.y)
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _load_or_compute_distance_field(self):
+        """ Load the distance field from the cache if we have seen this map
+            before, otherwise compute it and store it for the next run """
+        if self.cache_dir is None:
+            return compute_distance_field(self.grid > 0,
+                                          self.map.info.resolution)
+
+        path = self._cache_path()
+        if os.path.exists(path):
+            try:
+                closest_occ = np.load(path)
+                if closest_occ.shape == self.grid.shape:
+                    return closest_occ
+            except (IOError, ValueError) as e:
+                logger.warning("ignoring unreadable occupancy field cache "
+                               "%s: %s", path, e)
+
+        closest_occ = compute_distance_field(self.grid > 0,
+                                             self.map.info.resolution)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write to a temporary file first so that a concurrently starting
+            # node never reads a partially written field
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, closest_occ)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.warning("unable to cache occupancy field in %s: %s",
+                           self.cache_dir, e)
+        return closest_occ
+
+    def update_cells(self, rows, cols, values, radius=2.0, tile_size=64):
+        """ Set the occupancy values of the cells (rows, cols) of grid to
+            values and repair the distance field around the cells whose
+            occupancy changed, instead of rebuilding all of it.
+            Only distances shorter than radius are repaired exactly.  A
+            change in occupancy can only alter such distances within radius
+            of the changed cell, so the distance transform is recomputed in
+            a window reaching radius beyond that region.  Every other
+            distance is at least radius, but may be far larger than the exact
+            distance once obstacles were added (cells beyond the region keep
+            their old distance), so users that need a lower bound on the
+            distance to the closest obstacle (such as ray_casting.cast_rays)
+            must clamp closest_occ at exact_radius.  Changed cells are grouped
+            into tiles of tile_size cells so distant edits are repaired
+            separately.
+            Returns the list of (row slice, column slice) regions of
+            closest_occ that were repaired.  The on-disk cache is not
+            updated. """
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.intp))
+        cols = np.atleast_1d(np.asarray(cols, dtype=np.intp))
+        values = np.broadcast_to(np.asarray(values, dtype=np.int8),
+                                 rows.shape)
+        # only cells switching between occupied and not occupied matter
+        flipped = (self.grid[rows, cols] > 0) != (values > 0)
+        if np.any(self.grid[rows, cols] != values):
+            self.edits += 1
+        self.grid[rows, cols] = values
+        if len(rows):
+            self.free_cells = np.flatnonzero(self.grid == 0)
+        rows, cols = rows[flipped], cols[flipped]
+        if not len(rows):
+            return []
+
+        height, width = self.grid.shape
+        resolution = self.map.info.resolution
+        reach = int(math.ceil(radius/resolution))
+        self.exact_radius = min(self.exact_radius, radius)
+        tiles = np.unique(np.stack((rows//tile_size, cols//tile_size),
+                                   axis=-1),
+                          axis=0, return_inverse=True)[1].ravel()
+        regions = []
+        for tile in range(tiles.max() + 1):
+            in_tile = tiles == tile
+            row_min, row_max = rows[in_tile].min(), rows[in_tile].max()
+            col_min, col_max = cols[in_tile].min(), cols[in_tile].max()
+            region = (slice(max(row_min - reach, 0),
+                            min(row_max + reach + 1, height)),
+                      slice(max(col_min - reach, 0),
+                            min(col_max + reach + 1, width)))
+            window = (slice(max(row_min - 2*reach, 0),
+                            min(row_max + 2*reach + 1, height)),
+                      slice(max(col_min - 2*reach, 0),
+                            min(col_max + 2*reach + 1, width)))
+            distances = compute_distance_field(self.grid[window] > 0,
+                                               resolution)
+            distances = distances[region[0].start - window[0].start:
+                                  region[0].stop - window[0].start,
+                                  region[1].start - window[1].start:
+                                  region[1].stop - window[1].start]
+            # beyond radius the closest obstacle may lie outside the window
+            old = self.closest_occ[region]
+            self.closest_occ[region] = np.where(
+                distances < radius,
+                distances,
+                np.maximum(radius, np.minimum(old, distances)))
+            regions.append(region)
+        return regions
+
+    def sample_free_poses(self, n, rng=np.random, weights=None):
+        """ Return a (3, n) array of poses drawn uniformly from the free
+            cells of the map, with a uniform position within each cell and a
+            uniform heading.  weights optionally gives the relative
+            probability of drawing each of free_cells (for instance to favor
+            cells far from obstacles).  Without weights the cost only grows
+            with n. """
+        if not len(self.free_cells):
+            raise ValueError("the map has no free cells to sample from")
+        if weights is None:
+            cells = self.free_cells[
+                (rng.random(n)*len(self.free_cells)).astype(np.intp)]
+        else:
+            cells = self.free_cells[resampling.multinomial_resample(weights,
+                                                                    n, rng)]
+        rows, cols = np.divmod(cells, self.grid.shape[1])
+        info = self.map.info
+        poses = rng.random((3, n))
+        poses[0] += cols
+        poses[0] *= info.resolution
+        poses[0] += info.origin.position.x
+        poses[1] += rows
+        poses[1] *= info.resolution
+        poses[1] += info.origin.position.y
+        poses[2] *= 2*math.pi
+        poses[2] -= math.pi
+        return poses
 
     def get_closest_obstacle_distance(self, x, y):
         """ Compute the closest obstacle to the specified (x,y) coordinate in
             the map.  If the (x,y) coordinate is out of the map boundaries, nan
             will be returned. """
-        x_coord = \
-            int((x - self.map.info.origin.position.x)/self.map.info.resolution)
-        y_coord = \
-            int((y - self.map.info.origin.position.y)/self.map.info.resolution)
+        info = self.map.info
+        x_coord = (x - info.origin.position.x)/info.resolution
+        y_coord = (y - info.origin.position.y)/info.resolution
 
-        # check if we are in bounds
-        if x_coord > self.map.info.width or x_coord < 0:
+        # check if we are in bounds (this also rejects nan coordinates)
+        if not(0 <= x_coord < info.width):
             return float('nan')
-        if y_coord > self.map.info.height or y_coord < 0:
+        if not(0 <= y_coord < info.height):
             return float('nan')
 
-        ind = x_coord + y_coord*self.map.info.width
-        if ind >= self.map.info.width*self.map.info.height or ind < 0:
-            return float('nan')
-        return self.closest_occ[ind]
+        return float(self.closest_occ[int(y_coord), int(x_coord)])
+
+    def get_closest_obstacle_distances(self, xs, ys, fill_value=float('nan'),
+                                       interpolate=False):
+        """ Vectorized version of get_closest_obstacle_distance.  xs and ys
+            are arrays of any shape and the returned array of distances has the
+            same shape.  Coordinates outside of the map boundaries are assigned
+            fill_value.  If interpolate is True the distances are bilinearly
+            interpolated between cell centers, which keeps lookups smooth on
+            coarse grids. """
+        return lookup_distances(self.closest_occ,
+                                self.map.info.origin.position.x,
+                                self.map.info.origin.position.y,
+                                self.map.info.resolution,
+                                xs, ys,
+                                fill_value=fill_value,
+                                interpolate=interpolate)
@@ -0,0 +1,213 @@
+""" Evaluate the likelihood field model for large particle sets on several
+    cores.  The tabulated likelihood field of a map is placed in shared memory
+    once and a persistent pool of worker processes maps it, so the only data
+    passed per scan are the beam endpoints and the bounds of each worker's
+    shard of particles.  The particle poses and the resulting log likelihoods
+    are exchanged through shared buffers as well. """
+
+import collections
+import multiprocessing
+import weakref
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+from laser_model import LikelihoodFieldModel
+from map_loader import GridMap, MapInfo, Origin
+
+# shared memory segments and likelihood models attached to in a worker process
+_worker_segments = collections.OrderedDict()
+_worker_models = {}
+_WORKER_SEGMENT_LIMIT = 8
+
+
+def _attach(name):
+    """ Return the shared memory segment called name, attaching to it the
+        first time it is used by this process """
+    segment = _worker_segments.get(name)
+    if segment is not None:
+        _worker_segments.move_to_end(name)
+        return segment
+    # the segment belongs to the parent, which unlinks it when it is done
+    segment = shared_memory.SharedMemory(name=name)
+    _worker_segments[name] = segment
+    while len(_worker_segments) > _WORKER_SEGMENT_LIMIT:
+        old_name, old_segment = _worker_segments.popitem(last=False)
+        _worker_models.pop(old_name, None)
+        old_segment.close()
+    return segment
+
+
+class _TableField(object):
+    """ Stands in for the OccupancyField of a shared table in a worker, which
+        only needs the geometry of the map """
+
+    def __init__(self, map):
+        self.map = map
+
+
+def _shared_array(name, shape, dtype):
+    """ Return an array of shape and dtype backed by the segment name """
+    return np.ndarray(shape, dtype=dtype, buffer=_attach(name).buf)
+
+
+def _worker_model(table):
+    """ Return a LikelihoodFieldModel that scores against the shared table
+        described by table (see SharedLikelihoodField.table) """
+    name, shape, miss, info, interpolate, chunk_size = table
+    model = _worker_models.get(name)
+    if model is None or name not in _worker_segments:
+        padded_field = _shared_array(name, shape, np.float32)
+        model = LikelihoodFieldModel.__new__(LikelihoodFieldModel)
+        model.chunk_size = chunk_size
+        model.interpolate = interpolate
+        model.miss_log_likelihood = miss
+        model.padded_field = padded_field
+        model.log_likelihood_field = padded_field[1:-1, 1:-1]
+        resolution, origin_x, origin_y = info
+        model.occupancy_field = _TableField(GridMap(
+            MapInfo(resolution, shape[1] - 2, shape[0] - 2,
+                    Origin(origin_x, origin_y)), None))
+        _worker_models[name] = model
+    return model
+
+
+def _evaluate_shard(task):
+    """ Score the particles start:stop of the shared pose buffer against the
+        beam endpoints and write their log likelihoods into the shared
+        output buffer """
+    table, buffers, capacity, start, stop, beam_x, beam_y = task
+    poses_name, output_name = buffers
+    poses = _shared_array(poses_name, (3, capacity), np.float64)
+    output = _shared_array(output_name, (capacity,), np.float64)
+    model = _worker_model(table)
+    output[start:stop] = model.endpoint_log_likelihoods(
+        poses[:, start:stop], beam_x, beam_y)
+
+
+def _unlink(segment):
+    """ Release a shared memory segment created by this process """
+    try:
+        segment.unlink()
+    except OSError:
+        pass
+    try:
+        segment.close()
+    except BufferError:
+        # arrays still refer to the segment, it is unmapped along with them
+        pass
+
+
+def _create_segment(owner, nbytes):
+    """ Create a shared memory segment of at least nbytes that is released
+        when owner is garbage collected, the returned finalizer is called or
+        the process exits """
+    segment = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    return segment, weakref.finalize(owner, _unlink, segment)
+
+
+class WorkerPool(object):
+    """ A persistent pool of processes that evaluate likelihoods
+        Attributes:
+            workers: the number of worker processes
+            min_shard: the smallest number of particles given to one worker
+            capacity: the number of particles the shared buffers can hold
+    """
+
+    def __init__(self, workers=None, min_shard=2048):
+        if shared_memory is None:
+            raise RuntimeError("parallel likelihood evaluation requires "
+                               "python 3.8 or newer")
+        self.workers = workers or multiprocessing.cpu_count()
+        self.min_shard = min_shard
+        # spawned workers do not inherit the threads (and locks) of ROS
+        self._pool = multiprocessing.get_context('spawn').Pool(self.workers)
+        self._finalizer = weakref.finalize(self, self._pool.terminate)
+        self.capacity = 0
+        self._buffers = None
+
+    def _reserve(self, n):
+        """ Make sure the shared buffers can hold n particles """
+        if n <= self.capacity:
+            return
+        self.capacity = max(n, 2*self.capacity)
+        if self._buffers is not None:
+            for _, finalizer in self._buffers:
+                finalizer()
+        poses = _create_segment(self, 3*self.capacity*8)
+        output = _create_segment(self, self.capacity*8)
+        self._buffers = (poses, output)
+        self.poses = np.ndarray((3, self.capacity), dtype=np.float64,
+                                buffer=poses[0].buf)
+        self.output = np.ndarray((self.capacity,), dtype=np.float64,
+                                 buffer=output[0].buf)
+
+    def evaluate(self, table, poses, beam_x, beam_y):
+        """ Return the log likelihoods of the endpoints beam_x, beam_y for
+            each of the (3, n) poses, scored against the shared table """
+        n = poses.shape[1]
+        self._reserve(n)
+        self.poses[:, :n] = poses
+        shards = max(1, min(self.workers, n//self.min_shard))
+        bounds = np.linspace(0, n, shards + 1).astype(int)
+        buffers = (self._buffers[0][0].name, self._buffers[1][0].name)
+        beam_x = np.ascontiguousarray(beam_x, dtype=np.float64)
+        beam_y = np.ascontiguousarray(beam_y, dtype=np.float64)
+        self._pool.map(_evaluate_shard,
+                       [(table, buffers, self.capacity, start, stop,
+                         beam_x, beam_y)
+                        for start, stop in zip(bounds[:-1], bounds[1:])])
+        return self.output[:n].copy()
+
+    def close(self):
+        """ Stop the worker processes """
+        self._finalizer()
+
+
+class SharedLikelihoodField(LikelihoodFieldModel):
+    """ A LikelihoodFieldModel whose tabulated field lives in shared memory
+        and whose particles are scored in shards by a WorkerPool.  Updates of
+        the field (see update_region) are seen by the workers immediately.
+        Attributes:
+            pool: the WorkerPool that evaluates the shards
+            table: the description of the shared table passed to workers
+        See LikelihoodFieldModel for the remaining attributes.
+    """
+
+    def __init__(self, occupancy_field, pool, **params):
+        self.pool = pool
+        super(SharedLikelihoodField, self).__init__(occupancy_field,
+                                                    **params)
+
+    def set_field(self, occupancy_field):
+        """ Tabulate the log likelihood field of occupancy_field (see
+            LikelihoodFieldModel.set_field) and move it to shared memory """
+        super(SharedLikelihoodField, self).set_field(occupancy_field)
+        padded_field = self.padded_field
+        if getattr(self, '_finalizer', None) is not None:
+            self._finalizer()
+        self._segment, self._finalizer = _create_segment(self,
+                                                         padded_field.nbytes)
+        self.padded_field = np.ndarray(padded_field.shape, dtype=np.float32,
+                                       buffer=self._segment.buf)
+        self.padded_field[...] = padded_field
+        self.log_likelihood_field = self.padded_field[1:-1, 1:-1]
+        info = occupancy_field.map.info
+        self.table = (self._segment.name, padded_field.shape,
+                      self.miss_log_likelihood,
+                      (info.resolution, info.origin.position.x,
+                       info.origin.position.y),
+                      self.interpolate, self.chunk_size)
+
+    def endpoint_log_likelihoods(self, poses, beam_x, beam_y):
+        """ See LikelihoodFieldModel.endpoint_log_likelihoods.  Small
+            particle sets are scored in this process. """
+        poses = np.asarray(poses)
+        if poses.shape[1] < 2*self.pool.min_shard or not len(beam_x):
+            return super(SharedLikelihoodField, self).endpoint_log_likelihoods(
+                poses, beam_x, beam_y)
+        return self.pool.evaluate(self.table, poses, beam_x, beam_y)
@@ -0,0 +1,163 @@
+""" A particle set stored as a structure of arrays so that the motion model,
+    weighting and resampling steps can operate on every particle at once """
+
+import numpy as np
+
+from se2 import compose, odometry_motion, wrap_angle
+
+
+class ParticleCloud(object):
+    """ Represents a set of weighted hypotheses of the robot's pose.
+        The state of every particle lives in a single contiguous (4, n) array
+        whose rows are x, y, theta and w, so each row is itself contiguous and
+        can be handed out as a view without copying.
+        Attributes:
+            data: the (4, n) array of particle state
+            x: the x-coordinates of the hypotheses relative to the map frame
+            y: the y-coordinates of the hypotheses relative to the map frame
+            theta: the yaws of the hypotheses relative to the map frame
+            w: the particle weights (normalize() makes them sum to 1.0)
+    """
+    X, Y, THETA, W = range(4)
+
+    def __init__(self, x=(), y=(), theta=(), w=None):
+        """ Construct a new particle cloud from arrays of x, y and theta.  If
+            w is omitted all particles receive the same weight. """
+        x = np.asarray(x, dtype=np.float64)
+        self.data = np.empty((4, x.size))
+        self.data[self.X] = x
+        self.data[self.Y] = y
+        self.data[self.THETA] = theta
+        self.data[self.W] = 1.0 if w is None else w
+
+    @classmethod
+    def from_gaussian(cls, n, xy_theta, sigma_xy, sigma_theta, rng=np.random):
+        """ Create a cloud of n equally weighted particles normally
+            distributed around the pose xy_theta """
+        return cls(rng.normal(xy_theta[0], sigma_xy, n),
+                   rng.normal(xy_theta[1], sigma_xy, n),
+                   wrap_angle(rng.normal(xy_theta[2], sigma_theta, n)))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    @property
+    def x(self):
+        return self.data[self.X]
+
+    @x.setter
+    def x(self, value):
+        self.data[self.X] = value
+
+    @property
+    def y(self):
+        return self.data[self.Y]
+
+    @y.setter
+    def y(self, value):
+        self.data[self.Y] = value
+
+    @property
+    def theta(self):
+        return self.data[self.THETA]
+
+    @theta.setter
+    def theta(self, value):
+        self.data[self.THETA] = value
+
+    @property
+    def w(self):
+        return self.data[self.W]
+
+    @w.setter
+    def w(self, value):
+        self.data[self.W] = value
+
+    @property
+    def poses(self):
+        """ A (3, n) view of the x, y and theta rows of the cloud """
+        return self.data[:self.W]
+
+    def copy(self):
+        """ Return an independent copy of the cloud """
+        cloud = ParticleCloud.__new__(ParticleCloud)
+        cloud.data = self.data.copy()
+        return cloud
+
+    def resample(self, indices, extra_poses=None):
+        """ Replace the cloud by the particles at indices (which may contain
+            repeats and need not have the current length) and give them equal
+            weights.  The state is gathered with one fancy-indexing operation
+            so no per-particle copies are made.  extra_poses is an optional
+            (3, m) array of the poses of new particles to add to the cloud. """
+        if extra_poses is None or not np.shape(extra_poses)[1]:
+            self.data = self.data[:, indices]
+        else:
+            data = np.empty((4, len(indices) + np.shape(extra_poses)[1]))
+            data[:, :len(indices)] = self.data[:, indices]
+            data[:self.W, len(indices):] = extra_poses
+            self.data = data
+        if len(self):
+            self.w.fill(1.0/len(self))
+
+    def reweight(self, log_likelihoods):
+        """ Multiply the weights by the likelihoods whose logarithms are given
+            for every particle.  The update is performed in log space and
+            shifted by the largest value so that very small likelihoods do not
+            underflow to zero. """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_w = np.log(self.w) + log_likelihoods
+            log_w -= log_w.max()
+            self.w = np.exp(log_w)
+
+    def normalize(self):
+        """ Scale the weights in place so that they sum to 1.0.  If the
+            weights are degenerate (all zero or not finite) they are reset to
+            a uniform distribution. """
+        if not len(self):
+            return
+        w = self.w
+        total = w.sum()
+        if total > 0 and np.isfinite(total):
+            w /= total
+        else:
+            w.fill(1.0/len(self))
+
+    def apply_odometry(self, old_odom_xy_theta, new_odom_xy_theta,
+                       alphas=(0.1, 0.1, 0.1, 0.1), rng=np.random):
+        """ Move every particle according to the odometry-based motion model
+            (Probabilistic Robotics, table 5.6).  The motion between the two
+            odometry poses is decomposed into an initial rotation, a
+            translation and a final rotation.  Each component is perturbed
+            independently for every particle with noise whose variance grows
+            with the size of the motion, as scaled by the four alphas:
+                alphas[0]: rotation noise caused by rotation
+                alphas[1]: rotation noise caused by translation
+                alphas[2]: translation noise caused by translation
+                alphas[3]: translation noise caused by rotation
+        """
+        n = len(self)
+        if not n:
+            return
+        rot1, trans, rot2 = (float(component) for component in
+                             odometry_motion(old_odom_xy_theta,
+                                             new_odom_xy_theta))
+
+        # driving backwards should not be treated as a half turn when
+        # computing how much rotation noise to add
+        rot1_noise = min(abs(rot1), abs(wrap_angle(rot1 - np.pi)))
+        rot2_noise = min(abs(rot2), abs(wrap_angle(rot2 - np.pi)))
+        a1, a2, a3, a4 = alphas
+
+        rot1_hat = rot1 + rng.normal(
+            0.0, np.sqrt(a1*rot1_noise**2 + a2*trans**2), n)
+        trans_hat = trans + rng.normal(
+            0.0, np.sqrt(a3*trans**2 + a4*(rot1_noise**2 + rot2_noise**2)), n)
+        rot2_hat = rot2 + rng.normal(
+            0.0, np.sqrt(a1*rot2_noise**2 + a2*trans**2), n)
+
+        # apply the noisy motion in the frame of every particle at once
+        self.data[:self.W] = compose(self.poses,
+                                     (trans_hat*np.cos(rot1_hat),
+                                      trans_hat*np.sin(rot1_hat),
+                                      rot1_hat + rot2_hat))
@@ -2,10 +2,13 @@
 
 """ This is the starter code for the robot localization project """
 
+import threading
+
 import rospy
 from geometry_msgs.msg import PoseWithCovarianceStamped, PoseArray, Pose
 
 from helper_functions import TFHelper
+from map_loader import get_map
 from occupancy_field import OccupancyField
 
 
@@ -15,6 +18,10 @@ class ParticleFilter(object):
     def __init__(self):
         rospy.init_node('pf')
 
+        # set by the loader thread once occupancy_field can be used
+        self.occupancy_field = None
+        self.ready = threading.Event()
+
         # pose_listener responds to selection of a new approximate robot
         # location (for instance using rviz)
         rospy.Subscriber("initialpose",
@@ -27,14 +34,37 @@ class ParticleFilter(object):
                                             queue_size=10)
 
         # create instances of two helper objects that are provided to you
-        # as part of the project
-        self.occupancy_field = OccupancyField()
+        # as part of the project.  The map is read directly from the
+        # map_server YAML file in ~map_file when it is set, otherwise it is
+        # requested from map_server.  Computing its distance field takes a
+        # while, so it happens in the loader thread.
         self.transform_helper = TFHelper()
+        self.loader_thread = threading.Thread(target=self.load_map,
+                                              name="loader")
+        self.loader_thread.daemon = True
+        self.loader_thread.start()
+
+    def load_map(self):
+        """ Load the map and compute its distance field (in the loader
+            thread) """
+        try:
+            self.occupancy_field = OccupancyField(
+                get_map(rospy.get_param("~map_file", None)))
+        except Exception as e:
+            rospy.logfatal("failed to load the map: %s", e)
+            rospy.signal_shutdown("failed to load the map")
+            return
+        self.ready.set()
+        rospy.loginfo("map loaded")
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter
             based on a pose estimate.  These pose estimates could be generated
             by another ROS Node or could come from the rviz GUI """
+        if not self.ready.is_set():
+            rospy.logwarn("ignoring the initial pose, the map is still "
+                          "loading")
+            return
         xy_theta = \
             self.transform_helper.convert_pose_to_xy_and_theta(msg.pose.pose)
 
@@ -4,10 +4,13 @@
 
 import rospy
 
-from std_msgs.msg import Header, String
+from std_msgs.msg import Header, String, Int32
 from sensor_msgs.msg import LaserScan, PointCloud
-from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
+from geometry_msgs.msg import PoseStamped, PoseWithCovariance, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
+from nav_msgs.msg import OccupancyGrid
 from nav_msgs.srv import GetMap
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from std_srvs.srv import Empty, EmptyResponse
 from copy import deepcopy
 
 import tf
@@ -18,11 +21,12 @@ from random import gauss
 
 import math
 import time
+import threading
 
 import numpy as np
-from numpy.random import random_sample
-from sklearn.neighbors import NearestNeighbors
-from occupancy_field import OccupancyField
+from instrumentation import Metrics, MetricsLog, flatten_snapshot
+from scan_buffer import LatestBuffer
+import resampling
 from helper_functions import TFHelper
 
 class Particle(object):
@@ -56,25 +60,71 @@ class ParticleFilter:
     """ The class that represents a Particle Filter ROS Node
         Attributes list:
             initialized: a Boolean flag to communicate to other class methods that initializaiton is complete
+            ready: set once the map is loaded and the localizer is built.  This happens in the loader
+                   thread (see load_filter), so the node is subscribed and buffers the latest scan
+                   while the distance field is computed.  Initial poses received before then are
+                   applied once the filter is ready.
+            status_pub: publishes "loading map" or "ready" on ~status (latched)
+            start_time: when the node started (time.monotonic), time_to_ready and time_to_first_update
+                        are reported as metrics relative to it
             base_frame: the name of the robot base coordinate frame (should be "base_link" for most robots)
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
-            n_particles: the number of particles in the filter
-            d_thresh: the amount of linear movement before triggering a filter update
-            a_thresh: the amount of angular movement before triggering a filter update
-            laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
+            localizer: the Localizer that implements the filter.  Its parameters (n_particles, d_thresh,
+                       a_thresh, laser_max_distance, ...) can be overridden with the ~localizer parameter
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
-            particle_pub: a publisher for the particle cloud
+            particle_pub: a publisher for the particle cloud.  The cloud is only published while
+                          someone is subscribed, at most ~particle_publish_rate times per second
+                          (0 for every update) and subsampled according to the particle weights to at
+                          most ~max_published_particles particles (0 for no limit)
+            particle_count_pub: a publisher that reports the number of particles after every filter update
+            pose_pub: publishes the estimate of the robot's pose and its covariance in the map frame
             laser_subscriber: listens for new scan data on topic self.scan_topic
+            scan_buffer: holds the latest scan until the filter thread is ready for it.  Scans that
+                         are superseded or older than ~max_scan_age seconds are dropped (and counted)
+            filter_lock: serializes changes to the particle filter between the filter thread and
+                         callbacks such as update_initial_pose.  It is never held while waiting for
+                         tf, so the callbacks do not stall behind a slow transform.
+            pending_map_to_odom: the (robot_pose, timestamp) of the latest pose estimate, set under
+                                 filter_lock and turned into the map to odom transform by
+                                 update_map_to_odom once the lock is released
+            map_to_odom_lock: serializes update_map_to_odom, so an older estimate never overwrites
+                              the transform of a newer one
+            filter_thread: runs the filter on the scans taken from scan_buffer, so that neither the
+                           subscriber callbacks nor the main loop wait for a slow update
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
-            particle_cloud: a list of particles representing a probability distribution over robot poses
-            current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
-                                   The pose is expressed as a list [x,y,theta] (where theta is the yaw)
-            map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
+            particle_cloud: a ParticleCloud representing a probability distribution over robot poses
+            metrics: timers (stages of scan processing and TF waits), counters (received, updated and
+                     skipped scans) and gauges (particle count) describing the filter loop
+            diagnostics_pub: publishes a summary of metrics on /diagnostics every ~diagnostics_period seconds
+            metrics_log: appends the same summary to the CSV or JSON lines file ~metrics_log (if set)
+            occupancy_field: the map we will be localizing ourselves in as an OccupancyField.  The map is
+                             read from the map_server YAML file given by the ~map_file parameter (or
+                             is the ~initial_map of ~maps), or requested from the static_map service if
+                             neither is set
+            map_cache: a MapCache of the maps listed in the ~maps parameter (a dictionary from name to
+                       map_server YAML file, or a list of YAML files) and ~map_file.  The maps are
+                       loaded on demand (or up front if ~preload_maps is set) and the least recently
+                       used ones (other than the active map) are evicted beyond ~map_cache_budget
+                       megabytes
+            active_map: the name of the map we are localizing in (None for the static_map service map)
+            active_map_pub: publishes the name of the active map (latched)
+            recorder: if ~record is set, records every input of the filter (scans with their odometry
+                      and laser poses, initial poses, map switches and map edits) to that file, from which
+                      replay.py reproduces the run exactly.  The seed of the filter is ~seed (random
+                      if not set).
+            global_localization: a std_srvs/Empty service that spreads the particles over the free
+                                 space of the map, for when the robot is lost.  If the
+                                 ~global_localization parameter is set, the filter also starts
+                                 out this way instead of around the odometry pose.
+            map updates: if ~apply_map_updates is set, maps received on the map topic that match the
+                         size, resolution and origin of the active map are compared to it and the
+                         cells that differ are applied to the active map (see Localizer.update_map)
     """
     def __init__(self):
+        self.start_time = time.monotonic()
         self.initialized = False        # make sure we don't perform updates before everything is setup
         rospy.init_node('pf')           # tell roscore that we are creating a new node named "pf"
 
@@ -83,14 +133,16 @@ class ParticleFilter:
         self.odom_frame = "odom"        # the name of the odometry coordinate frame
         self.scan_topic = "scan"        # the topic where we will get laser scans from 
 
-        self.n_particles = 300          # the number of particles to use
+        self.metrics = Metrics()
 
-        self.d_thresh = 0.2             # the amount of linear movement before performing an update
-        self.a_thresh = math.pi/6       # the amount of angular movement before performing an update
-
-        self.laser_max_distance = 2.0   # maximum penalty to assess in the likelihood field model
-
-        # TODO: define additional constants if needed
+        # scans are handed from the subscriber callback to the filter thread through a latest-only buffer
+        self.scan_buffer = LatestBuffer(capacity=1,
+                                        max_age=rospy.get_param("~max_scan_age", 1.0),
+                                        clock=rospy.get_time,
+                                        on_drop=self.scan_dropped)
+        self.filter_lock = threading.Lock()
+        self.pending_map_to_odom = None
+        self.map_to_odom_lock = threading.Lock()
 
         # Setup pubs and subs
 
@@ -99,6 +151,16 @@ class ParticleFilter:
 
         # publish the current particle cloud.  This enables viewing particles in rviz.
         self.particle_pub = rospy.Publisher("particlecloud", PoseArray, queue_size=10)
+        self.particle_publish_rate = rospy.get_param("~particle_publish_rate", 5.0)
+        self.max_published_particles = rospy.get_param("~max_published_particles", 1000)
+        self.last_particle_publish = None
+        self.publish_rng = np.random.default_rng()
+
+        # publish the estimated pose of the robot and how certain we are of it
+        self.pose_pub = rospy.Publisher("estimated_pose", PoseWithCovarianceStamped, queue_size=10)
+
+        # report how many particles the filter chose to use
+        self.particle_count_pub = rospy.Publisher("particle_count", Int32, queue_size=10)
 
         # laser_subscriber listens for data from the lidar
         rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
@@ -107,8 +169,6 @@ class ParticleFilter:
         self.tf_listener = TransformListener()
         self.tf_broadcaster = TransformBroadcaster()
 
-        self.particle_cloud = []
-
         # change use_projected_stable_scan to True to use point clouds instead of laser scans
         self.use_projected_stable_scan = False
         self.last_projected_stable_scan = None
@@ -116,71 +176,285 @@ class ParticleFilter:
             # subscriber to the odom point cloud
             rospy.Subscriber("projected_stable_scan", PointCloud, self.projected_scan_received)
 
-        self.current_odom_xy_theta = []
-        self.occupancy_field = OccupancyField()
+        # the filter is built by the loader thread, until it is ready scans wait in scan_buffer
+        self.ready = threading.Event()
+        self.localizer = None
+        self.occupancy_field = None
+        self.map_cache = None
+        self.active_map = None
+        self.recorder = None
+        self.pending_initial_pose = None
+        self.time_to_first_update = None
+        self.status_pub = rospy.Publisher("~status", String, queue_size=1, latch=True)
+        self.status_pub.publish(String(data="loading map"))
+
+        # switch between the maps of map_cache by publishing their names
+        self.active_map_pub = rospy.Publisher("~active_map", String, queue_size=1, latch=True)
+        rospy.Subscriber("~switch_map", String, self.switch_map)
+        self.start_globally = rospy.get_param("~global_localization", False)
+        rospy.Service("global_localization", Empty, self.global_localization)
+        if rospy.get_param("~apply_map_updates", False):
+            rospy.Subscriber("map", OccupancyGrid, self.map_received)
         self.transform_helper = TFHelper()
+
+        # periodically report the metrics of the filter loop
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=1)
+        metrics_log = rospy.get_param("~metrics_log", None)
+        self.metrics_log = MetricsLog(metrics_log) if metrics_log else None
+        rospy.Timer(rospy.Duration(rospy.get_param("~diagnostics_period", 1.0)), self.publish_diagnostics)
         self.initialized = True
 
+        self.loader_thread = threading.Thread(target=self.load_filter, name="loader")
+        self.loader_thread.daemon = True
+        self.loader_thread.start()
+        self.filter_thread = threading.Thread(target=self.run_filter, name="filter")
+        self.filter_thread.daemon = True
+        self.filter_thread.start()
+        rospy.on_shutdown(self.scan_buffer.close)
+
+    def load_filter(self):
+        """ Load the map, compute its distance field and build the localizer.  This runs in the
+            loader thread so that the node is up (and buffering scans) while the field is built. """
+        try:
+            # imported here to keep the map and filter modules off the start up path of the node
+            from occupancy_field import OccupancyField
+            from map_loader import get_map, LOAD_ERRORS
+            from map_cache import MapCache
+            from localizer import Localizer
+            from recording import Recorder
+
+            # load the map straight from disk if we know where it is, otherwise ask map_server for it
+            map_cache = MapCache(rospy.get_param("~maps", {}),
+                                 memory_budget=int(rospy.get_param("~map_cache_budget", 256)*2**20))
+            map_file = rospy.get_param("~map_file", None)
+            active_map = rospy.get_param("~initial_map", None)
+            if map_file:
+                active_map = map_cache.add(map_file)
+            elif active_map is None and map_cache.names():
+                active_map = map_cache.names()[0]
+            entry = None
+            if active_map is not None:
+                try:
+                    entry = map_cache.get(active_map)
+                except LOAD_ERRORS as e:
+                    if not map_file:
+                        raise
+                    # like get_map, fall back to map_server if ~map_file cannot be loaded
+                    rospy.logwarn("unable to load map %s (%s), waiting for the static_map service "
+                                  "instead", map_file, e)
+                    map_cache.remove(active_map)
+                    active_map = None
+            if entry is not None:
+                map_cache.pin(active_map)
+                occupancy_field = entry.field
+                derived = entry.derived
+            else:
+                occupancy_field = OccupancyField(get_map())
+                derived = None
+            localizer_params = rospy.get_param("~localizer", {})
+            seed = rospy.get_param("~seed", None)
+            if seed is None:
+                seed = np.random.SeedSequence().entropy
+            localizer = Localizer(occupancy_field, seed=seed, derived=derived, **localizer_params)
+            recorder = None
+            if rospy.get_param("~record", None):
+                recorder = Recorder(rospy.get_param("~record"), seed, localizer_params,
+                                    map_cache.map_files)
+                if active_map is not None:
+                    recorder.map(rospy.get_time(), active_map)
+                rospy.on_shutdown(self.close_recorder)
+        except Exception as e:
+            rospy.logfatal("failed to set up the particle filter: %s", e)
+            rospy.signal_shutdown("failed to set up the particle filter")
+            return
+
+        with self.filter_lock:
+            self.map_cache = map_cache
+            self.active_map = active_map
+            self.occupancy_field = occupancy_field
+            self.localizer = localizer
+            self.recorder = recorder
+            if self.pending_initial_pose is not None:
+                self.initialize_particle_cloud(*self.pending_initial_pose)
+                self.pending_initial_pose = None
+            self.ready.set()
+        self.update_map_to_odom()
+        if active_map is not None:
+            self.active_map_pub.publish(String(data=active_map))
+        time_to_ready = time.monotonic() - self.start_time
+        self.metrics.gauge("time_to_ready", time_to_ready)
+        self.status_pub.publish(String(data="ready"))
+        rospy.loginfo("particle filter ready after %.2f s", time_to_ready)
+
+        if rospy.get_param("~preload_maps", False):
+            map_cache.preload()
+
+    def publish_diagnostics(self, event=None):
+        """ Publish a snapshot of the metrics of the filter loop as a diagnostic_msgs/DiagnosticArray
+            (timer values are in milliseconds) and append it to the metrics log """
+        snapshot = self.metrics.snapshot()
+        values = []
+        for key, value in sorted(flatten_snapshot(snapshot).items()):
+            if key.rsplit('.', 1)[-1] in ('p50', 'p95', 'p99', 'max'):
+                value *= 1000
+            values.append(KeyValue(key=key, value=str(value)))
+        if self.ready.is_set():
+            level, message = DiagnosticStatus.OK, "%d particles" % len(self.particle_cloud)
+        else:
+            level, message = DiagnosticStatus.WARN, "loading map"
+        status = DiagnosticStatus(level=level,
+                                  name="%s: particle filter" % rospy.get_name(),
+                                  message=message,
+                                  hardware_id="",
+                                  values=values)
+        self.diagnostics_pub.publish(DiagnosticArray(header=Header(stamp=rospy.Time.now()),
+                                                     status=[status]))
+        if self.metrics_log:
+            self.metrics_log.write(snapshot)
+
+    def switch_map(self, msg):
+        """ Callback function to start localizing in the map of map_cache named by msg (a
+            std_msgs/String).  The particle cloud is initialized again with the next scan. """
+        if not self.ready.is_set():
+            rospy.logwarn("ignoring the switch to map %r, the filter is still loading", msg.data)
+            return
+        if msg.data not in self.map_cache:
+            rospy.logwarn("unknown map %r (known maps: %s)", msg.data, ", ".join(self.map_cache.names()))
+            return
+        # loading the map (if it is not cached) happens outside of the filter lock
+        entry = self.map_cache.get(msg.data)
+        with self.filter_lock:
+            self.occupancy_field = entry.field
+            self.localizer.set_map(entry.field, entry.derived)
+            self.active_map = entry.name
+            self.map_cache.pin(entry.name)
+            if self.recorder:
+                self.recorder.map(rospy.get_time(), entry.name)
+        # building the measurement model tables of a new map adds to the size of the cache
+        self.map_cache.trim()
+        self.active_map_pub.publish(String(data=entry.name))
+        rospy.loginfo("switched to map %s", entry.name)
+
+    def global_localization(self, request):
+        """ Service handler that spreads the particles over the free space of the map """
+        with self.filter_lock:
+            if self.localizer is None:
+                rospy.logwarn("ignoring the request for global localization, the filter is still loading")
+            else:
+                self.initialize_particle_cloud(rospy.Time.now(), global_localization=True)
+                rospy.loginfo("spread %d particles over the map", len(self.particle_cloud))
+        self.update_map_to_odom()
+        return EmptyResponse()
+
+    def map_received(self, msg):
+        """ Callback function to apply the cells of the map in msg (a nav_msgs/OccupancyGrid) that
+            differ from the active map, e.g. doors that were opened or obstacles that were added """
+        if not self.ready.is_set():
+            rospy.logwarn("ignoring a map update, the filter is still loading")
+            return
+        info = self.occupancy_field.map.info
+        if (msg.info.width, msg.info.height) != (info.width, info.height) or \
+                abs(msg.info.resolution - info.resolution) > 1e-9 or \
+                abs(msg.info.origin.position.x - info.origin.position.x) > 1e-9 or \
+                abs(msg.info.origin.position.y - info.origin.position.y) > 1e-9:
+            rospy.logwarn("ignoring a map update that does not match the geometry of the active map")
+            return
+        grid = np.asarray(msg.data, dtype=np.int8).reshape(info.height, info.width)
+        rows, cols = np.nonzero(grid != self.occupancy_field.grid)
+        if not len(rows):
+            return
+        with self.metrics.timer("map_update"), self.filter_lock:
+            self.localizer.update_map(rows, cols, grid[rows, cols])
+            if self.recorder:
+                self.recorder.map_update(rospy.get_time(), rows, cols, grid[rows, cols])
+            stale = self.localizer.ray_caster_stale()
+        self.metrics.count("map_cells_updated", len(rows))
+        if stale:
+            # rebuilding the ray casting table takes a while, the filter keeps using the stale one
+            # meanwhile.  Edits only come from this callback, so the map is not edited under us.
+            with self.metrics.timer("ray_caster_rebuild"):
+                ray_caster = self.localizer.build_ray_caster()
+            with self.filter_lock:
+                self.localizer.install_ray_caster(ray_caster)
+
+    def close_recorder(self):
+        """ Write out what is left of the recording """
+        with self.filter_lock:
+            self.recorder.close()
+            self.recorder = None
+
+    @property
+    def particle_cloud(self):
+        return self.localizer.particle_cloud
+
     def update_robot_pose(self, timestamp):
         """ Update the estimate of the robot's pose given the updated particles.
-            There are two logical methods for this:
-                (1): compute the mean pose
-                (2): compute the most likely pose (i.e. the mode of the distribution)
+            By default the localizer takes the mean of the heaviest cluster of particles (an
+            approximation of the mode of the distribution), which unlike the mean of the whole
+            cloud stays on one of the hypotheses when the cloud is multimodal.
         """
-        # first make sure that the particle weights are normalized
-        self.normalize_particles()
-
-        # TODO: assign the latest pose into self.robot_pose as a geometry_msgs.Pose object
-        # just to get started we will fix the robot's pose to always be at the origin
-        self.robot_pose = Pose()
-
-        self.transform_helper.fix_map_to_odom_transform(self.robot_pose, timestamp)
+        x, y, theta = self.localizer.update_pose_estimate()
+        self.robot_pose = self.transform_helper.convert_xy_and_theta_to_poses([x], [y], [theta])[0]
+
+        # the covariance of the planar pose goes into the x, y and yaw rows and columns of the
+        # 6x6 covariance of the message
+        covariance = np.zeros((6, 6))
+        covariance[np.ix_((0, 1, 5), (0, 1, 5))] = self.localizer.robot_covariance
+        self.pose_pub.publish(PoseWithCovarianceStamped(header=Header(stamp=timestamp,
+                                                                      frame_id=self.map_frame),
+                                                        pose=PoseWithCovariance(pose=self.robot_pose,
+                                                                                covariance=covariance.ravel().tolist())))
+
+        self.pending_map_to_odom = (self.robot_pose, timestamp)
+
+    def update_map_to_odom(self):
+        """ Fix the map to odom transform to the latest pose estimate (if it changed).  This waits
+            for tf, so it is called after releasing filter_lock. """
+        with self.map_to_odom_lock:
+            with self.filter_lock:
+                pending, self.pending_map_to_odom = self.pending_map_to_odom, None
+            if pending is not None:
+                with self.metrics.timer("tf_wait_odom"):
+                    self.transform_helper.fix_map_to_odom_transform(*pending)
 
     def projected_scan_received(self, msg):
         self.last_projected_stable_scan = msg
 
     def update_particles_with_odom(self, msg):
         """ Update the particles using the newly given odometry pose.
-            The function computes the value delta which is a tuple (x,y,theta)
-            that indicates the change in position and angle between the odometry
-            when the particles were last updated and the current odometry.
+            The change in position and angle between the odometry when the particles were
+            last updated and the current odometry is applied to every particle by the localizer.
 
             msg: this is not really needed to implement this, but is here just in case.
         """
         new_odom_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        # compute the change in x,y,theta since our last update
-        if self.current_odom_xy_theta:
-            old_odom_xy_theta = self.current_odom_xy_theta
-            delta = (new_odom_xy_theta[0] - self.current_odom_xy_theta[0],
-                     new_odom_xy_theta[1] - self.current_odom_xy_theta[1],
-                     new_odom_xy_theta[2] - self.current_odom_xy_theta[2])
-
-            self.current_odom_xy_theta = new_odom_xy_theta
-        else:
-            self.current_odom_xy_theta = new_odom_xy_theta
-            return
-
-        # TODO: modify particles using delta
+        self.localizer.update_particles_with_odom(new_odom_xy_theta)
 
     def map_calc_range(self,x,y,theta):
-        """ Difficulty Level 3: implement a ray tracing likelihood model... Let me know if you are interested """
-        # TODO: nothing unless you want to try this alternate likelihood model
-        pass
+        """ Return the range a laser beam starting at (x,y) pointing in the direction theta should
+            measure given the map (see Localizer.map_calc_range) """
+        return self.localizer.map_calc_range(x, y, theta)
 
     def resample_particles(self):
         """ Resample the particles according to the new particle weights.
             The weights stored with each particle should define the probability that a particular
-            particle is selected in the resampling step.  You may want to make use of the given helper
-            function draw_random_sample.
+            particle is selected in the resampling step.  Resampling is skipped while the effective
+            sample size shows that the weights are still well spread out.  The number of particles
+            is published either way.
         """
-        # make sure the distribution is normalized
-        self.normalize_particles()
-        # TODO: fill out the rest of the implementation
+        if self.localizer.resample_particles():
+            rospy.logdebug("resampled to %d particles", len(self.particle_cloud))
+        self.particle_count_pub.publish(Int32(data=len(self.particle_cloud)))
 
     def update_particles_with_laser(self, msg):
         """ Updates the particle weights in response to the scan contained in the msg """
-        # TODO: implement this
-        pass
+        laser_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.laser_pose.pose)
+        self.localizer.update_particles_with_laser(msg.ranges,
+                                                   msg.angle_min,
+                                                   msg.angle_increment,
+                                                   laser_xy_theta,
+                                                   msg.range_min,
+                                                   msg.range_max)
 
     @staticmethod
     def draw_random_sample(choices, probabilities, n):
@@ -188,105 +462,187 @@ class ParticleFilter:
             choices: the values to sample from represented as a list
             probabilities: the probability of selecting each element in choices represented as a list
             n: the number of samples
+            The particle cloud itself is resampled with the index based samplers in the resampling
+            module, this helper remains for sampling arbitrary python objects.
         """
-        values = np.array(range(len(choices)))
-        probs = np.array(probabilities)
-        bins = np.add.accumulate(probs)
-        inds = values[np.digitize(random_sample(n), bins)]
-        samples = []
-        for i in inds:
-            samples.append(deepcopy(choices[int(i)]))
-        return samples
+        inds = resampling.multinomial_resample(probabilities, n)
+        return [deepcopy(choices[i]) for i in inds]
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
             These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
         xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(msg.pose.pose)
-        self.initialize_particle_cloud(msg.header.stamp, xy_theta)
-
-    def initialize_particle_cloud(self, timestamp, xy_theta=None):
+        with self.filter_lock:
+            if self.localizer is None:
+                # the filter is still loading, start from this pose once it is ready
+                self.pending_initial_pose = (msg.header.stamp, xy_theta)
+                return
+            self.initialize_particle_cloud(msg.header.stamp, xy_theta)
+        self.update_map_to_odom()
+
+    def initialize_particle_cloud(self, timestamp, xy_theta=None, global_localization=False):
         """ Initialize the particle cloud.
             Arguments
             xy_theta: a triple consisting of the mean x, y, and theta (yaw) to initialize the
-                      particle cloud around.  If this input is omitted, the odometry will be used """
-        if xy_theta is None:
+                      particle cloud around.  If this input is omitted, the odometry will be used
+            global_localization: spread the particles over the free space of the map instead """
+        if xy_theta is None and not global_localization:
             xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        self.particle_cloud = []
-        # TODO create particles
-
-        self.normalize_particles()
+        if self.recorder:
+            self.recorder.initial_pose(timestamp.to_sec(), xy_theta)
+        self.localizer.initialize_particle_cloud(xy_theta)
         self.update_robot_pose(timestamp)
 
     def normalize_particles(self):
         """ Make sure the particle weights define a valid distribution (i.e. sum to 1.0) """
-        # TODO: implement this
-        pass
+        self.localizer.normalize_particles()
 
     def publish_particles(self, msg):
-        particles_conv = []
-        for p in self.particle_cloud:
-            particles_conv.append(p.as_pose())
+        """ Publish (a weighted subsample of) the particle cloud for visualization """
+        if not self.particle_pub.get_num_connections():
+            # nobody is listening, don't bother building the message
+            return
+        now = rospy.get_time()
+        if self.particle_publish_rate > 0 and self.last_particle_publish is not None and \
+                now - self.last_particle_publish < 1.0/self.particle_publish_rate:
+            return
+        self.last_particle_publish = now
+
+        cloud = self.particle_cloud
+        poses = cloud.poses
+        if 0 < self.max_published_particles < len(cloud):
+            # draw the particles to show in proportion to their weights (without repeats, which
+            # would be drawn on top of each other anyway)
+            indices = resampling.systematic_resample(cloud.w, self.max_published_particles,
+                                                     self.publish_rng)
+            poses = poses[:, np.unique(indices)]
+        particles_conv = self.transform_helper.convert_xy_and_theta_to_poses(*poses)
         # actually send the message so that we can view it in rviz
         self.particle_pub.publish(PoseArray(header=Header(stamp=rospy.Time.now(),
                                             frame_id=self.map_frame),
                                   poses=particles_conv))
 
     def scan_received(self, msg):
-        """ This is the default logic for what to do when processing scan data.
-            Feel free to modify this, however, we hope it will provide a good
-            guide.  The input msg is an object of type sensor_msgs/LaserScan """
+        """ Hand the scan in msg (a sensor_msgs/LaserScan) over to the filter thread.  This returns
+            immediately, any scan still waiting to be processed is superseded by the new one. """
         if not(self.initialized):
             # wait for initialization to complete
             return
-
+        self.metrics.count("scans_received")
+        self.scan_buffer.put(msg, msg.header.stamp.to_sec())
+
+    def scan_dropped(self, msg, reason):
+        """ Count a scan that was dropped from scan_buffer before being processed """
+        self.metrics.count("scans_dropped")
+        self.metrics.count("scans_dropped_" + reason)
+
+    def run_filter(self):
+        """ Process the scans from scan_buffer until the node shuts down """
+        while not(self.ready.wait(0.5)):
+            if rospy.is_shutdown():
+                return
+        while not(rospy.is_shutdown()):
+            msg = self.scan_buffer.get()
+            if msg is None:
+                # the buffer was closed
+                return
+            with self.metrics.timer("scan"):
+                # tf is waited for before taking the filter lock, see filter_lock
+                poses = self.lookup_scan_poses(msg)
+                if poses is not None:
+                    with self.filter_lock:
+                        self.process_scan(msg, *poses)
+                    self.update_map_to_odom()
+            self.metrics.gauge("particles", len(self.particle_cloud))
+            self.metrics.gauge("injected_particles", self.localizer.injected_particles)
+            cache = self.localizer.likelihood_cache
+            if cache is not None:
+                self.metrics.gauge("likelihood_cache_hits", cache.hits)
+                self.metrics.gauge("likelihood_cache_misses", cache.misses)
+
+    def lookup_scan_poses(self, msg):
+        """ Return the pose of the laser relative to the robot base and the pose of the robot in
+            the odometry frame at the time of the scan msg, or None if tf cannot tell yet """
         # wait a little while to see if the transform becomes available.  This fixes a race
         # condition where the scan would arrive a little bit before the odom to base_link transform
         # was updated.
-        self.tf_listener.waitForTransform(self.base_frame, msg.header.frame_id, msg.header.stamp, rospy.Duration(0.5))
+        with self.metrics.timer("tf_wait_laser"):
+            self.tf_listener.waitForTransform(self.base_frame, msg.header.frame_id, msg.header.stamp, rospy.Duration(0.5))
         if not(self.tf_listener.canTransform(self.base_frame, msg.header.frame_id, msg.header.stamp)):
             # need to know how to transform the laser to the base frame
             # this will be given by either Gazebo or neato_node
-            return
+            self.metrics.count("scans_skipped_no_laser_tf")
+            return None
 
         if not(self.tf_listener.canTransform(self.base_frame, self.odom_frame, msg.header.stamp)):
             # need to know how to transform between base and odometric frames
             # this will eventually be published by either Gazebo or neato_node
-            return
+            self.metrics.count("scans_skipped_no_odom_tf")
+            return None
 
         # calculate pose of laser relative to the robot base
         p = PoseStamped(header=Header(stamp=rospy.Time(0),
                                       frame_id=msg.header.frame_id))
-        self.laser_pose = self.tf_listener.transformPose(self.base_frame, p)
+        laser_pose = self.tf_listener.transformPose(self.base_frame, p)
 
         # find out where the robot thinks it is based on its odometry
         p = PoseStamped(header=Header(stamp=msg.header.stamp,
                                       frame_id=self.base_frame),
                         pose=Pose())
-        self.odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+        odom_pose = self.tf_listener.transformPose(self.odom_frame, p)
+        return laser_pose, odom_pose
+
+    def process_scan(self, msg, laser_pose, odom_pose):
+        """ This is the default logic for what to do when processing scan data.
+            Feel free to modify this, however, we hope it will provide a good
+            guide.  The input msg is an object of type sensor_msgs/LaserScan, taken by the laser
+            at laser_pose relative to the robot base while the robot was at odom_pose (see
+            lookup_scan_poses) """
+        self.laser_pose = laser_pose
+        self.odom_pose = odom_pose
         # store the the odometry pose in a more convenient format (x,y,theta)
         new_odom_xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(self.odom_pose.pose)
-        if not self.current_odom_xy_theta:
-            self.current_odom_xy_theta = new_odom_xy_theta
+        if self.recorder:
+            self.recorder.scan(msg.header.stamp.to_sec(),
+                               new_odom_xy_theta,
+                               self.transform_helper.convert_pose_to_xy_and_theta(self.laser_pose.pose),
+                               msg.ranges,
+                               msg.angle_min,
+                               msg.angle_increment,
+                               msg.range_min,
+                               msg.range_max)
+        if self.localizer.current_odom_xy_theta is None:
+            self.localizer.current_odom_xy_theta = new_odom_xy_theta
             return
 
         if not(self.particle_cloud):
             # now that we have all of the necessary transforms we can update the particle cloud
-            self.initialize_particle_cloud(msg.header.stamp)
-        elif (math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or
-              math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or
-              math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh):
+            self.initialize_particle_cloud(msg.header.stamp, global_localization=self.start_globally)
+        elif self.localizer.moved_enough(new_odom_xy_theta):
             # we have moved far enough to do an update!
-            self.update_particles_with_odom(msg)    # update based on odometry
+            self.metrics.count("updates")
+            with self.metrics.timer("odom"):
+                self.update_particles_with_odom(msg)    # update based on odometry
             if self.last_projected_stable_scan:
                 last_projected_scan_timeshift = deepcopy(self.last_projected_stable_scan)
                 last_projected_scan_timeshift.header.stamp = msg.header.stamp
                 self.scan_in_base_link = self.tf_listener.transformPointCloud("base_link", last_projected_scan_timeshift)
 
-            self.update_particles_with_laser(msg)   # update based on laser scan
-            self.update_robot_pose(msg.header.stamp)                # update robot's pose
-            self.resample_particles()               # resample particles to focus on areas of high density
+            with self.metrics.timer("laser"):
+                self.update_particles_with_laser(msg)   # update based on laser scan
+            with self.metrics.timer("pose"):
+                self.update_robot_pose(msg.header.stamp)                # update robot's pose
+            with self.metrics.timer("resample"):
+                self.resample_particles()               # resample particles to focus on areas of high density
+            if self.time_to_first_update is None:
+                self.time_to_first_update = time.monotonic() - self.start_time
+                self.metrics.gauge("time_to_first_update", self.time_to_first_update)
+                rospy.loginfo("first update after %.2f s", self.time_to_first_update)
+        else:
+            self.metrics.count("scans_skipped_not_moved")
         # publish particles (so things like rviz can see them)
-        self.publish_particles(msg)
+        with self.metrics.timer("publish"):
+            self.publish_particles(msg)
 
 if __name__ == '__main__':
     n = ParticleFilter()
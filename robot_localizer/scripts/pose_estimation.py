@@ -0,0 +1,111 @@
+""" Estimates of the robot's pose from a particle cloud.  The weighted mean of
+    the whole cloud lands between the modes of a multimodal cloud, so the
+    clustered estimate first hashes the particles into an (x, y, theta) grid,
+    joins neighboring occupied cells into clusters and only averages the
+    particles of the heaviest cluster.  Every step works on whole arrays, so
+    the cost grows linearly with the number of particles. """
+
+import math
+
+import numpy as np
+
+from se2 import angle_diff
+
+
+def weighted_pose_mean(x, y, theta, w):
+    """ Return the weighted mean (x, y, theta) of a set of poses and the 3x3
+        weighted covariance of x, y and theta.  The mean of theta is the
+        circular mean and its deviations are measured on the circle. """
+    w = np.asarray(w, dtype=np.float64)
+    w = w/w.sum()
+    mean_theta = math.atan2(np.dot(w, np.sin(theta)),
+                            np.dot(w, np.cos(theta)))
+    deviations = np.stack((x - np.dot(w, x),
+                           y - np.dot(w, y),
+                           angle_diff(theta, mean_theta)))
+    covariance = np.dot(deviations*w, deviations.T)
+    return ((float(np.dot(w, x)), float(np.dot(w, y)), mean_theta),
+            covariance)
+
+
+def _wrap_links(labels):
+    """ Return the pairs of labels of the cells in the first and last theta
+        slice of labels that are neighbors across the theta wrap around """
+    first = np.pad(labels[:, :, 0], 1, 'constant')
+    last = labels[:, :, -1]
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            shifted = first[1 + dx:first.shape[0] - 1 + dx,
+                            1 + dy:first.shape[1] - 1 + dy]
+            linked = (shifted > 0) & (last > 0)
+            pairs.append(np.stack((shifted[linked], last[linked])))
+    return np.concatenate(pairs, axis=1)
+
+
+def cluster_labels(x, y, theta, cell_size, max_cells=1 << 22):
+    """ Return the cluster of every pose, numbered from 0.  The poses are
+        hashed into (x, y, theta) cells of cell_size and cells that touch
+        (including diagonally and across the theta wrap around) form a
+        cluster.  If the cells spanned by the cloud would exceed max_cells,
+        every occupied cell is treated as a cluster of its own. """
+    turns = max(1, int(round(2*math.pi/cell_size[2])))
+    ix = np.floor((x - x.min())/cell_size[0]).astype(np.intp)
+    iy = np.floor((y - y.min())/cell_size[1]).astype(np.intp)
+    it = np.floor((np.asarray(theta) + math.pi) /
+                  (2*math.pi)*turns).astype(np.intp) % turns
+    shape = (ix.max() + 1, iy.max() + 1, turns)
+    if shape[0]*shape[1]*shape[2] > max_cells:
+        cells = np.stack((ix, iy, it), axis=-1)
+        return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+    # imported here to keep scipy off the start up path of the node
+    from scipy import ndimage
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    occupied = np.zeros(shape, dtype=bool)
+    occupied[ix, iy, it] = True
+    labels, count = ndimage.label(occupied, structure=np.ones((3, 3, 3)))
+    if turns > 2:
+        links = _wrap_links(labels)
+        if links.shape[1]:
+            graph = coo_matrix((np.ones(links.shape[1]), links),
+                               shape=(count + 1, count + 1))
+            components = connected_components(graph, directed=False)[1]
+            labels = components[labels]
+    return np.unique(labels[ix, iy, it], return_inverse=True)[1]
+
+
+def cluster_pose_estimate(x, y, theta, w, cell_size=(0.5, 0.5, math.pi/6),
+                          previous=None, hysteresis=0.2):
+    """ Return the weighted mean pose and covariance (see weighted_pose_mean)
+        of the heaviest cluster of particles (see cluster_labels), together
+        with the fraction of the total weight in that cluster.
+        If previous (the last estimate) lies in a cluster holding at least
+        1 - hysteresis times the weight of the heaviest one, that cluster is
+        used instead, which keeps the estimate from jumping back and forth
+        between modes of similar weight. """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    theta = np.asarray(theta, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+    if previous is not None:
+        # the previous estimate is clustered as a particle without weight
+        x = np.append(x, previous[0])
+        y = np.append(y, previous[1])
+        theta = np.append(theta, previous[2])
+        w = np.append(w, 0.0)
+    labels = cluster_labels(x, y, theta, cell_size)
+    cluster_weights = np.bincount(labels, weights=w)
+    best = np.argmax(cluster_weights)
+    if previous is not None:
+        current = labels[-1]
+        if cluster_weights[current] >= \
+                (1 - hysteresis)*cluster_weights[best] and \
+                cluster_weights[current] > 0:
+            best = current
+    members = labels == best
+    pose, covariance = weighted_pose_mean(x[members], y[members],
+                                          theta[members], w[members])
+    return pose, covariance, cluster_weights[best]/cluster_weights.sum()
@@ -0,0 +1,230 @@
+""" A ray casting engine that predicts the range a laser beam would measure
+    from any pose in the map.  Expected ranges are precomputed for a grid of
+    (x, y, theta) cells over the free space of the map and stored in a
+    quantized table that is memory-mapped from disk, so several nodes can
+    share a single copy.  Poses outside of the table are handled by marching
+    rays on demand. """
+
+import logging
+import os
+
+import numpy as np
+
+from occupancy_field import DEFAULT_CACHE_DIR, lookup_distances, map_hash
+
+logger = logging.getLogger(__name__)
+
+
+def cast_rays(occupancy_field, xs, ys, thetas, max_range):
+    """ Return the distance from each (x, y) to the first occupied cell along
+        the direction theta, or max_range if no obstacle is found within
+        max_range (or the ray leaves the map).  The inputs can be arrays of
+        any broadcastable shape and every ray is marched at once.  Each step
+        advances a ray by its distance to the closest obstacle (less a cell
+        of slack for the discretization of the field), so rays move quickly
+        through open space and slow down near walls.  Steps are capped at the
+        exact_radius of the field, beyond which the distances of an edited
+        field may overestimate the distance to the closest obstacle. """
+    info = occupancy_field.map.info
+    resolution = info.resolution
+    origin_x = info.origin.position.x
+    origin_y = info.origin.position.y
+    xs, ys, thetas = np.broadcast_arrays(np.asarray(xs, dtype=np.float64),
+                                         np.asarray(ys, dtype=np.float64),
+                                         np.asarray(thetas, dtype=np.float64))
+    shape = xs.shape
+    ranges = np.full(xs.size, float(max_range))
+
+    # state of the rays that are still marching
+    active = np.arange(xs.size)
+    x = xs.ravel().copy()
+    y = ys.ravel().copy()
+    c = np.cos(thetas.ravel())
+    s = np.sin(thetas.ravel())
+    traveled = np.zeros(xs.size)
+    min_step = 0.5*resolution
+
+    while active.size:
+        distances = lookup_distances(occupancy_field.closest_occ,
+                                     origin_x, origin_y, resolution,
+                                     x, y, fill_value=-1.0)
+        hit = distances == 0
+        ranges[active[hit]] = traveled[hit]
+
+        step = np.maximum(np.minimum(distances, occupancy_field.exact_radius) -
+                          resolution, min_step)
+        traveled += step
+        # rays that left the map or exceeded max_range keep max_range
+        marching = ~hit & (distances > 0) & (traveled < max_range)
+        active = active[marching]
+        traveled = traveled[marching]
+        step = step[marching]
+        c = c[marching]
+        s = s[marching]
+        x = x[marching] + step*c
+        y = y[marching] + step*s
+
+    return ranges.reshape(shape)
+
+
+class RayCaster(object):
+    """ Precomputed expected ranges for the free space of a map
+        Attributes:
+            occupancy_field: the OccupancyField rays are cast against
+            max_range: the longest range that is reported (meters)
+            table_resolution: the size of the (x, y) cells of the table
+            angular_bins: the number of theta cells of the table
+            range_quantum: the range represented by one unit of the table
+            cell_index: a (rows, cols) array that maps each (x, y) cell of the
+            table to its row of ranges, or -1 if the cell is not in free space
+            ranges: the (number of free cells, angular_bins) uint16 table of
+            quantized expected ranges
+            edits: the edits count of occupancy_field the table was built at
+            (the table is stale once the field was edited again)
+    """
+
+    def __init__(self, occupancy_field, max_range=5.0, table_resolution=0.1,
+                 angular_bins=180, cache_dir=DEFAULT_CACHE_DIR,
+                 chunk_size=1 << 20):
+        self.occupancy_field = occupancy_field
+        self.edits = occupancy_field.edits
+        self.max_range = max_range
+        self.table_resolution = table_resolution
+        self.angular_bins = angular_bins
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        # the largest quantized value is reserved for max_range
+        self.range_quantum = max_range/np.iinfo(np.uint16).max
+
+        info = occupancy_field.map.info
+        self.origin_x = info.origin.position.x
+        self.origin_y = info.origin.position.y
+        cols = int(np.ceil(info.width*info.resolution/table_resolution))
+        rows = int(np.ceil(info.height*info.resolution/table_resolution))
+
+        # a table cell is in free space if its center lies in a free cell
+        fine_x = ((np.arange(cols) + 0.5) *
+                  table_resolution/info.resolution).astype(np.intp)
+        fine_y = ((np.arange(rows) + 0.5) *
+                  table_resolution/info.resolution).astype(np.intp)
+        free = occupancy_field.grid[np.ix_(np.minimum(fine_y, info.height - 1),
+                                           np.minimum(fine_x, info.width - 1))
+                                    ] == 0
+        self.cell_index = np.full((rows, cols), -1, dtype=np.int32)
+        self.cell_index[free] = np.arange(np.count_nonzero(free))
+
+        self.ranges = self._load_or_compute_table()
+
+    def _cache_path(self):
+        """ Return the path of the cache file for the table of the current
+            map and parameters """
+        info = self.occupancy_field.map.info
+        key = map_hash(self.occupancy_field.grid, info.resolution,
+                       self.origin_x, self.origin_y)
+        return os.path.join(self.cache_dir, 'rays-%s-%g-%g-%d.npy' %
+                            (key, self.max_range, self.table_resolution,
+                             self.angular_bins))
+
+    def _compute_table(self, table):
+        """ Fill table with the quantized expected ranges of every free cell
+            of the table """
+        rows, cols = np.nonzero(self.cell_index >= 0)
+        xs = self.origin_x + (cols + 0.5)*self.table_resolution
+        ys = self.origin_y + (rows + 0.5)*self.table_resolution
+        thetas = self.bin_angles()
+        cells_per_chunk = max(1, self.chunk_size//self.angular_bins)
+        for start in range(0, len(xs), cells_per_chunk):
+            stop = min(start + cells_per_chunk, len(xs))
+            ranges = cast_rays(self.occupancy_field,
+                               xs[start:stop, np.newaxis],
+                               ys[start:stop, np.newaxis],
+                               thetas,
+                               self.max_range)
+            table[start:stop] = self.quantize(ranges)
+
+    def _load_or_compute_table(self):
+        """ Memory-map the table from the cache, computing it first if this
+            map has not been seen before.  If the cache cannot be written the
+            table is kept in memory instead. """
+        shape = (int(np.count_nonzero(self.cell_index >= 0)),
+                 self.angular_bins)
+        if self.cache_dir is None:
+            return self._compute_table_in_memory(shape)
+
+        path = self._cache_path()
+        if os.path.exists(path):
+            try:
+                table = np.load(path, mmap_mode='r')
+                if table.shape == shape and table.dtype == np.uint16:
+                    return table
+            except (IOError, ValueError):
+                pass
+
+        # fill a temporary file so that other nodes never map a partially
+        # computed table
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            table = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                              dtype=np.uint16, shape=shape)
+            self._compute_table(table)
+            table.flush()
+            del table
+            os.replace(tmp_path, path)
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError) as e:
+            logger.warning("unable to cache ray casting table in %s: %s",
+                           self.cache_dir, e)
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return self._compute_table_in_memory(shape)
+
+    def _compute_table_in_memory(self, shape):
+        """ Return a table of shape computed in memory """
+        table = np.empty(shape, dtype=np.uint16)
+        self._compute_table(table)
+        return table
+
+    def bin_angles(self):
+        """ Return the angle at the center of each theta cell of the table """
+        return (np.arange(self.angular_bins) + 0.5)*2*np.pi/self.angular_bins
+
+    def quantize(self, ranges):
+        """ Convert ranges in meters to the quantized units of the table """
+        return np.rint(np.minimum(ranges, self.max_range) /
+                       self.range_quantum).astype(np.uint16)
+
+    def map_calc_range(self, xs, ys, thetas):
+        """ Return the expected range measured by a beam starting at each
+            (x, y) in direction theta.  The inputs can be arrays of any
+            broadcastable shape (for instance a column of particles against a
+            row of beams) and the result has the broadcast shape.  Poses whose
+            cell is not in the table are ray cast on demand. """
+        xs, ys, thetas = np.broadcast_arrays(np.asarray(xs, dtype=np.float64),
+                                             np.asarray(ys, dtype=np.float64),
+                                             np.asarray(thetas,
+                                                        dtype=np.float64))
+        rows, cols = self.cell_index.shape
+        u = np.floor((xs - self.origin_x)/self.table_resolution)
+        v = np.floor((ys - self.origin_y)/self.table_resolution)
+        in_grid = (u >= 0) & (u < cols) & (v >= 0) & (v < rows)
+        cells = np.full(xs.shape, -1, dtype=np.intp)
+        cells[in_grid] = self.cell_index[v[in_grid].astype(np.intp),
+                                         u[in_grid].astype(np.intp)]
+        in_table = cells >= 0
+        bins = np.floor(thetas*self.angular_bins/(2*np.pi)).astype(np.intp)
+        bins %= self.angular_bins
+
+        ranges = np.empty(xs.shape)
+        ranges[in_table] = self.ranges[cells[in_table], bins[in_table]] * \
+            self.range_quantum
+        missing = ~in_table
+        if missing.any():
+            ranges[missing] = cast_rays(self.occupancy_field,
+                                        xs[missing], ys[missing],
+                                        thetas[missing], self.max_range)
+        return ranges
@@ -0,0 +1,196 @@
+""" A compact binary log of everything the filter consumes, for replaying a
+    run of the node deterministically without ROS.
+
+    A recording starts with the magic bytes b'PFREC\\x01\\n', the length of a
+    JSON header (little endian uint32) and the header itself, which holds the
+    seed of the filter's random number generator, the Localizer parameters
+    and the maps of the run.  It is followed by chunks, each made of a 16 byte
+    chunk header (b'CHNK', the event kind as a uint8, 3 pad bytes, the number
+    of records and the number of laser beams as uint32) and an array of
+    fixed-size records of the kind's dtype (see record_dtype).  Records are
+    buffered and written one chunk at a time, and a chunk only holds events
+    of a single kind, so the order of the chunks is the order of the events.
+    Edits of the active map are recorded one per chunk, with the number of
+    edited cells in place of the number of laser beams.
+    Reading memory-maps every chunk, so recordings of any size are streamed
+    without copying. """
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'PFREC\x01\n'
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sB3xII')
+
+SCAN, INITIAL_POSE, MAP, MAP_UPDATE = 1, 2, 3, 4
+KINDS = {SCAN: 'scan', INITIAL_POSE: 'initial_pose', MAP: 'map',
+         MAP_UPDATE: 'map_update'}
+
+
+def record_dtype(kind, beams=0):
+    """ Return the numpy dtype of the records of kind.  Scans have a field
+        for each of the beams ranges, map updates for each of beams edited
+        cells. """
+    if kind == SCAN:
+        return np.dtype([('stamp', '<f8'),
+                         ('odom', '<f8', (3,)),
+                         ('laser', '<f8', (3,)),
+                         ('angle_min', '<f8'),
+                         ('angle_increment', '<f8'),
+                         ('range_min', '<f8'),
+                         ('range_max', '<f8'),
+                         ('ranges', '<f4', (beams,))])
+    if kind == INITIAL_POSE:
+        return np.dtype([('stamp', '<f8'), ('pose', '<f8', (3,))])
+    if kind == MAP:
+        return np.dtype([('stamp', '<f8'), ('name', 'S64')])
+    if kind == MAP_UPDATE:
+        return np.dtype([('stamp', '<f8'),
+                         ('rows', '<i4', (beams,)),
+                         ('cols', '<i4', (beams,)),
+                         ('values', 'i1', (beams,))])
+    raise ValueError("unknown event kind %r" % kind)
+
+
+class Recorder(object):
+    """ Appends the inputs of the filter to a recording
+        Attributes:
+            path: the file being written
+            chunk_size: the number of records buffered before a chunk is
+            written
+    """
+
+    def __init__(self, path, seed, params=None, maps=None, chunk_size=256):
+        """ Start a recording at path of a filter whose random number
+            generator was seeded with seed and that was created with the
+            Localizer parameters params.  maps is a dictionary from map name
+            to map_server YAML file. """
+        self.path = path
+        self.chunk_size = chunk_size
+        self._file = open(path, 'wb')
+        header = json.dumps(dict(seed=seed, params=params or {},
+                                 maps=maps or {})).encode('utf-8')
+        self._file.write(MAGIC)
+        self._file.write(struct.pack('<I', len(header)))
+        self._file.write(header)
+        self._pending = None
+        self._pending_key = None
+        self._count = 0
+
+    def _append(self, kind, beams, record):
+        """ Buffer record, writing out the pending chunk first if it holds
+            a different kind of event """
+        if self._pending_key != (kind, beams):
+            self.flush()
+            self._pending = np.empty(self.chunk_size,
+                                     dtype=record_dtype(kind, beams))
+            self._pending_key = (kind, beams)
+            self._count = 0
+        self._pending[self._count] = record
+        self._count += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def scan(self, stamp, odom_xy_theta, laser_xy_theta, ranges, angle_min,
+             angle_increment, range_min, range_max):
+        """ Record a scan along with the odometry pose of the robot and the
+            pose of the laser on the robot at the time of the scan """
+        ranges = np.asarray(ranges, dtype=np.float32)
+        self._append(SCAN, len(ranges),
+                     (stamp, odom_xy_theta, laser_xy_theta, angle_min,
+                      angle_increment, range_min, range_max, ranges))
+
+    def initial_pose(self, stamp, xy_theta):
+        """ Record that the particle cloud was initialized around xy_theta,
+            or over the whole map if xy_theta is None (which is recorded as
+            a pose of nans) """
+        if xy_theta is None:
+            xy_theta = (np.nan, np.nan, np.nan)
+        self._append(INITIAL_POSE, 0, (stamp, xy_theta))
+
+    def map(self, stamp, name):
+        """ Record a switch to the named map """
+        self._append(MAP, 0, (stamp, name.encode('utf-8')))
+
+    def map_update(self, stamp, rows, cols, values):
+        """ Record that the cells (rows, cols) of the active map were set to
+            values """
+        rows = np.asarray(rows, dtype=np.int32)
+        self._append(MAP_UPDATE, len(rows),
+                     (stamp, rows, np.asarray(cols, dtype=np.int32),
+                      np.asarray(values, dtype=np.int8)))
+
+    def flush(self):
+        """ Write the buffered records out as a chunk """
+        if self._pending_key is None or not self._count:
+            return
+        kind, beams = self._pending_key
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, kind, self._count,
+                                           beams))
+        self._file.write(self._pending[:self._count].tobytes())
+        self._file.flush()
+        self._pending_key = None
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class Recording(object):
+    """ A recording opened for reading
+        Attributes:
+            path: the file of the recording
+            seed: the seed of the filter's random number generator
+            params: the Localizer parameters of the recorded filter
+            maps: a dictionary from map name to map_server YAML file
+            chunks: a list of (kind, offset, count, beams) of every chunk
+    """
+
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a filter recording" % path)
+            length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(length).decode('utf-8'))
+            self.chunks = []
+            offset = f.tell()
+            while offset + CHUNK_HEADER.size <= size:
+                f.seek(offset)
+                magic, kind, count, beams = CHUNK_HEADER.unpack(
+                    f.read(CHUNK_HEADER.size))
+                if magic != CHUNK_MAGIC:
+                    raise ValueError("corrupt chunk at byte %d of %s" %
+                                     (offset, path))
+                offset += CHUNK_HEADER.size
+                end = offset + count*record_dtype(kind, beams).itemsize
+                if end > size:
+                    # a chunk cut short by a crash while recording
+                    break
+                self.chunks.append((kind, offset, count, beams))
+                offset = end
+        self.seed = header['seed']
+        self.params = header['params']
+        self.maps = header['maps']
+
+    def read_chunk(self, chunk):
+        """ Return the records of chunk as a read-only memory-mapped array """
+        kind, offset, count, beams = chunk
+        return np.memmap(self.path, dtype=record_dtype(kind, beams),
+                         mode='r', offset=offset, shape=(count,))
+
+    def events(self):
+        """ Yield (kind name, record) for every recorded event in order """
+        for chunk in self.chunks:
+            name = KINDS[chunk[0]]
+            for record in self.read_chunk(chunk):
+                yield name, record
+
+    def scans(self):
+        """ Return the number of recorded scans """
+        return sum(count for kind, _, count, _ in self.chunks if kind == SCAN)
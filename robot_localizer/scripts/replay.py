@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+""" Replay a recording of the filter's inputs (see recording.py) at full
+    speed without ROS.  The filter is seeded and configured like the recorded
+    one and goes through the same steps in the same order, so a replay
+    reproduces the estimates of the recorded run exactly.
+
+    Example:
+        replay.py /tmp/pf.rec --estimates /tmp/estimates.csv
+"""
+
+import argparse
+import collections
+import csv
+import time
+
+import numpy as np
+
+from harness import StageTimes
+from localizer import Localizer
+from map_cache import MapCache
+from map_loader import load_map
+from occupancy_field import OccupancyField
+from recording import Recording
+
+Replay = collections.namedtuple('Replay', ['localizer', 'estimates',
+                                           'stage_times', 'seconds'])
+
+
+def replay(recording, map_file=None, stage_times=None, **params):
+    """ Feed every event of recording to a Localizer created with the
+        recorded seed and parameters (overridden by params) and return a
+        Replay holding the localizer, a (updates, 4) array of the stamp, x, y
+        and theta of every pose estimate, the StageTimes of the filter stages
+        and the duration of the replay.  The map is the one named by the
+        first map event of the recording, or map_file if it is given, in which
+        case the recorded edits of the map are not applied either.  A ray
+        casting table made stale by an edit is rebuilt right away, whereas
+        the node keeps using it until the rebuild in the background is done,
+        so beam model runs with map edits are not reproduced exactly. """
+    params = dict(recording.params, **params)
+    maps = MapCache(recording.maps)
+    stages = StageTimes() if stage_times is None else stage_times
+    localizer = None
+    if map_file is not None:
+        localizer = Localizer(OccupancyField(load_map(map_file)),
+                              seed=recording.seed, **params)
+
+    estimates = []
+    start = time.perf_counter()
+    for kind, record in recording.events():
+        if kind == 'map':
+            if map_file is not None:
+                continue
+            entry = maps.get(record['name'].decode('utf-8'))
+            if localizer is None:
+                localizer = Localizer(entry.field, seed=recording.seed,
+                                      derived=entry.derived, **params)
+            else:
+                localizer.set_map(entry.field, entry.derived)
+            maps.pin(entry.name)
+            maps.trim()
+        elif localizer is None:
+            raise ValueError("%s does not name its map, pass one explicitly"
+                             % recording.path)
+        elif kind == 'map_update':
+            if map_file is not None:
+                continue
+            localizer.update_map(record['rows'].astype(np.intp),
+                                 record['cols'].astype(np.intp),
+                                 np.array(record['values']))
+            if localizer.ray_caster_stale():
+                localizer.install_ray_caster(localizer.build_ray_caster())
+        elif kind == 'initial_pose':
+            pose = tuple(record['pose'])
+            if np.isnan(pose).all():
+                # global localization
+                pose = None
+            localizer.initialize_particle_cloud(pose)
+            localizer.update_pose_estimate()
+        elif localizer.update(tuple(record['odom']),
+                              record['ranges'],
+                              float(record['angle_min']),
+                              float(record['angle_increment']),
+                              tuple(record['laser']),
+                              float(record['range_min']),
+                              float(record['range_max']),
+                              timer=stages.timer):
+            estimates.append((float(record['stamp']),) +
+                             tuple(localizer.robot_xy_theta))
+    return Replay(localizer=localizer,
+                  estimates=np.array(estimates).reshape(-1, 4),
+                  stage_times=stages,
+                  seconds=time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording')
+    parser.add_argument('--map', help="the map_server YAML file to localize "
+                                      "in instead of the recorded map")
+    parser.add_argument('--estimates', help="write the pose estimates to "
+                                            "this CSV file")
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    result = replay(recording, args.map)
+    updates = len(result.estimates)
+    print("%d scans, %d updates in %.2f s (%.1f scans/sec)" %
+          (recording.scans(), updates, result.seconds,
+           recording.scans()/result.seconds if result.seconds else 0.0))
+    print("%-10s %9s %9s %9s" % ("stage", "p50 ms", "p95 ms", "p99 ms"))
+    for stage in ("odom", "laser", "pose", "resample"):
+        print("%-10s %9.2f %9.2f %9.2f" %
+              ((stage,) + tuple(1000*t for t in
+                                result.stage_times.percentiles(stage))))
+    if updates:
+        print("final estimate: x %.3f, y %.3f, theta %.3f" %
+              tuple(result.estimates[-1, 1:]))
+    if args.estimates:
+        with open(args.estimates, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stamp', 'x', 'y', 'theta'])
+            writer.writerows(result.estimates.tolist())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+""" Resampling strategies for the particle filter.  Every resampler takes an
+    array of particle weights and returns an array of the indices of the
+    particles that survive, so the particle state can be gathered with a
+    single fancy-indexing operation instead of copying particles one by one.
+"""
+
+import numpy as np
+
+
+def effective_sample_size(weights):
+    """ Return the effective sample size 1/sum(w^2) of the (possibly
+        unnormalized) weights.  It ranges from 1 when a single particle holds
+        all of the weight to len(weights) when the weights are uniform. """
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+    if not(total > 0):
+        return 0.0
+    return total**2/np.dot(weights, weights)
+
+
+def _cumulative(weights):
+    """ Return the normalized cumulative sum of weights """
+    cumulative = np.cumsum(weights, dtype=np.float64)
+    cumulative /= cumulative[-1]
+    # guard against round-off leaving the last bin slightly below 1.0
+    cumulative[-1] = 1.0
+    return cumulative
+
+
+def _select(weights, positions):
+    """ Return the index of the particle whose cumulative weight bin contains
+        each position in [0, 1) """
+    return np.searchsorted(_cumulative(weights), positions, side='right')
+
+
+def multinomial_resample(weights, n=None, rng=np.random):
+    """ Draw n indices independently with probabilities given by weights """
+    n = len(weights) if n is None else n
+    return _select(weights, rng.random(n))
+
+
+def stratified_resample(weights, n=None, rng=np.random):
+    """ Draw one index from each of n equally sized strata of the cumulative
+        weight distribution, using an independent offset per stratum """
+    n = len(weights) if n is None else n
+    return _select(weights, (np.arange(n) + rng.random(n))/n)
+
+
+def systematic_resample(weights, n=None, rng=np.random):
+    """ Draw n indices using a single random offset shared by n evenly spaced
+        pointers into the cumulative weight distribution (the low variance
+        sampler of Probabilistic Robotics, table 4.4) """
+    n = len(weights) if n is None else n
+    return _select(weights, (np.arange(n) + rng.random())/n)
+
+
+def residual_resample(weights, n=None, rng=np.random):
+    """ Deterministically keep floor(n*w) copies of every particle and fill
+        the remaining slots by stratified resampling of the residual
+        weights """
+    n = len(weights) if n is None else n
+    weights = np.asarray(weights, dtype=np.float64)
+    scaled = n*weights/weights.sum()
+    counts = np.floor(scaled).astype(np.intp)
+    indices = np.repeat(np.arange(len(weights)), counts)
+    n_residual = n - len(indices)
+    if n_residual > 0:
+        residual = scaled - counts
+        indices = np.concatenate((indices,
+                                  stratified_resample(residual,
+                                                      n_residual,
+                                                      rng)))
+    return indices
+
+
+def histogram_bins(xs, ys, thetas, bin_size):
+    """ Return the index of the (x, y, theta) histogram bin of bin_size that
+        contains each pose, numbered consecutively from 0 """
+    cells = np.stack((np.floor(xs/bin_size[0]),
+                      np.floor(ys/bin_size[1]),
+                      np.floor(thetas/bin_size[2])), axis=-1).astype(np.int64)
+    return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+
+def kld_sample_count(k, epsilon=0.05, z=2.33):
+    """ Return the number of samples needed so that, with the probability
+        whose upper standard normal quantile is z, the KL divergence between
+        the sample based and true distributions over k occupied histogram
+        bins stays below epsilon (Fox, "Adapting the Sample Size in Particle
+        Filters Through KLD-Sampling") """
+    k = np.asarray(k, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = 2.0/(9.0*(k - 1))
+        n = (k - 1)/(2*epsilon)*(1 - a + np.sqrt(a)*z)**3
+    return np.where(k > 1, np.ceil(n), 1.0)
+
+
+def kld_resample(weights, bins, min_particles, max_particles, epsilon=0.05,
+                 z=2.33, method='systematic', rng=np.random):
+    """ Resample with an adaptive number of particles.  bins gives the
+        histogram bin of every particle.  Up to max_particles candidates are
+        drawn in random order and the result is the shortest prefix of them
+        that is at least as long as kld_sample_count for the number of bins
+        the prefix occupies (and at least min_particles long).  This is the
+        same stopping rule as sequential KLD-sampling, evaluated for every
+        prefix at once. """
+    indices = resample(weights, max_particles, method, rng)
+    indices = indices[rng.permutation(len(indices))]
+    # the number of distinct bins occupied by the first n candidates
+    first = np.unique(bins[indices], return_index=True)[1]
+    new_bin = np.zeros(len(indices), dtype=np.intp)
+    new_bin[first] = 1
+    occupied = np.cumsum(new_bin)
+    n = np.arange(1, len(indices) + 1)
+    enough = (n >= kld_sample_count(occupied, epsilon, z)) & \
+        (n >= min_particles)
+    count = np.argmax(enough) + 1 if enough.any() else len(indices)
+    return indices[:count]
+
+
+RESAMPLERS = {'multinomial': multinomial_resample,
+              'stratified': stratified_resample,
+              'systematic': systematic_resample,
+              'residual': residual_resample}
+
+
+def resample(weights, n=None, method='systematic', rng=np.random):
+    """ Return n indices drawn according to weights using the named
+        resampling method (one of the keys of RESAMPLERS) """
+    try:
+        resampler = RESAMPLERS[method]
+    except KeyError:
+        raise ValueError("unknown resampling method %r (expected one of %s)"
+                         % (method, ', '.join(sorted(RESAMPLERS))))
+    return resampler(weights, n, rng)
@@ -0,0 +1,102 @@
+""" A bounded hand-off between the threads that receive sensor messages and
+    the thread that runs the filter.  Producers never block: once the buffer
+    is full the oldest message is dropped, and messages that have grown older
+    than a maximum age by the time the consumer gets to them are dropped as
+    well, so the filter always works on recent data. """
+
+import collections
+import threading
+import time
+
+
+class LatestBuffer(object):
+    """ A thread safe queue holding at most capacity of the most recent items
+        (with capacity 1 it only ever holds the latest item)
+        Attributes:
+            capacity: the maximum number of items held
+            max_age: items older than this (seconds) are dropped instead of
+            being returned by get (None to keep items regardless of age)
+            clock: returns the current time in the same units and epoch as
+            the stamps passed to put
+            on_drop: called with the item and the reason ("superseded" or
+            "stale") whenever an item is dropped (or None)
+            dropped: a dictionary from reason to the number of dropped items
+            closed: True once close has been called
+    """
+
+    def __init__(self, capacity=1, max_age=None, clock=time.time,
+                 on_drop=None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.max_age = max_age
+        self.clock = clock
+        self.on_drop = on_drop
+        self.dropped = {'superseded': 0, 'stale': 0}
+        self.closed = False
+        self._items = collections.deque()
+        self._ready = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        with self._ready:
+            return len(self._items)
+
+    def _drop(self, item, reason):
+        self.dropped[reason] += 1
+        if self.on_drop is not None:
+            self.on_drop(item, reason)
+
+    def put(self, item, stamp=None):
+        """ Add item taken at stamp (defaults to now), dropping the oldest
+            item if the buffer is full.  Never blocks for longer than it
+            takes to acquire the buffer's lock. """
+        stamp = self.clock() if stamp is None else stamp
+        superseded = None
+        with self._ready:
+            if self.closed:
+                return
+            if len(self._items) == self.capacity:
+                superseded = self._items.popleft()[1]
+            self._items.append((stamp, item))
+            self._ready.notify()
+        if superseded is not None:
+            self._drop(superseded, 'superseded')
+
+    def get(self, timeout=None):
+        """ Remove and return the oldest item that is not stale, waiting up
+            to timeout seconds (forever if None) for one to arrive.  Returns
+            None if the wait timed out or the buffer was closed. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stale = []
+            item = None
+            with self._ready:
+                while not self._items and not self.closed:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                    self._ready.wait(remaining)
+                if self.closed or not self._items:
+                    return None
+                now = self.clock()
+                while self._items:
+                    stamp, candidate = self._items.popleft()
+                    if self.max_age is not None and \
+                            now - stamp > self.max_age:
+                        stale.append(candidate)
+                    else:
+                        item = candidate
+                        break
+            for candidate in stale:
+                self._drop(candidate, 'stale')
+            if item is not None:
+                return item
+
+    def close(self):
+        """ Discard any queued items and wake up every waiting consumer """
+        with self._ready:
+            self.closed = True
+            self._items.clear()
+            self._ready.notify_all()
@@ -0,0 +1,191 @@
+""" Refine poses by aligning a scan with the distance field of the map.  The
+    likelihood field model only scores poses, so how well the filter
+    localizes is bounded by how densely the particles cover the true pose.
+    The ScanMatcher moves a few poses (the heaviest particles or the pose
+    estimate) to where the scan is most likely under the likelihood field
+    model, i.e. where the beam endpoints lie closest to obstacles, with a few
+    Gauss-Newton iterations run on all poses at once.  Since the likelihood
+    of an endpoint levels off at z_rand far from obstacles, endpoints that do
+    not match the map (such as those of unmapped obstacles) barely pull on
+    the pose, unlike in a plain least squares fit of the distances. """
+
+import numpy as np
+
+from laser_model import RangeFinderModel
+from se2 import wrap_angle
+
+
+class ScanMatcher(RangeFinderModel):
+    """ Aligns scans with an occupancy field
+        Attributes:
+            occupancy_field: the OccupancyField to align scans with
+            max_distance: distances to the closest obstacle are truncated to
+            this value, so beams ending further away from every obstacle (or
+            outside of the map) do not pull on the pose
+            sigma_hit, z_hit, z_rand: the parameters of the likelihood of an
+            endpoint (see laser_model.LikelihoodFieldModel)
+            damping: added to the diagonal of the Gauss-Newton system, which
+            keeps the steps short when few beams constrain the pose
+            table: a (height + 2, width + 2, 3) array holding the truncated
+            distance to the closest obstacle and its x and y derivatives in
+            each cell of the map, surrounded by a one cell border of cells
+            max_distance from every obstacle.  The border lets coordinates
+            be clipped into the table instead of being bounds checked.
+        See RangeFinderModel for the remaining attributes.
+    """
+
+    def __init__(self, occupancy_field, max_distance=2.0, sigma_hit=0.1,
+                 z_hit=0.9, z_rand=0.1, damping=1e-3, beam_stride=1,
+                 max_range=None, chunk_size=1 << 18):
+        super(ScanMatcher, self).__init__(beam_stride, max_range, chunk_size)
+        self.max_distance = max_distance
+        self.sigma_hit = sigma_hit
+        self.z_hit = z_hit
+        self.z_rand = z_rand
+        self.damping = damping
+        self.set_field(occupancy_field)
+
+    def _tabulate(self, closest_occ):
+        """ Return the table of the truncated distances closest_occ """
+        distances = np.minimum(closest_occ, self.max_distance)
+        resolution = self.occupancy_field.map.info.resolution
+        table = np.empty(distances.shape + (3,), dtype=np.float32)
+        table[..., 0] = distances
+        if min(distances.shape) > 1:
+            # rows of the field run along y and columns along x
+            table[..., 2], table[..., 1] = np.gradient(distances, resolution)
+        else:
+            table[..., 1:] = 0.0
+        return table
+
+    def set_field(self, occupancy_field):
+        """ Align scans with occupancy_field from now on, tabulating its
+            distance field and gradient """
+        self.occupancy_field = occupancy_field
+        height, width = occupancy_field.closest_occ.shape
+        self.table = np.zeros((height + 2, width + 2, 3), dtype=np.float32)
+        self.table[..., 0] = self.max_distance
+        self.table[1:-1, 1:-1] = self._tabulate(occupancy_field.closest_occ)
+
+    def update_region(self, region):
+        """ Tabulate the distance field and gradient again within region (a
+            pair of row and column slices of the map), after the distance
+            field changed there """
+        rows, cols = region
+        height, width = self.occupancy_field.closest_occ.shape
+        # the gradient at the edge of the region depends on the cells
+        # just outside of it
+        outer = (slice(max(rows.start - 1, 0), min(rows.stop + 1, height)),
+                 slice(max(cols.start - 1, 0), min(cols.stop + 1, width)))
+        table = self._tabulate(self.occupancy_field.closest_occ[outer])
+        self.table[rows.start + 1:rows.stop + 1,
+                   cols.start + 1:cols.stop + 1] = \
+            table[rows.start - outer[0].start:rows.stop - outer[0].start,
+                  cols.start - outer[1].start:cols.stop - outer[1].start]
+
+    def lookup(self, xs, ys):
+        """ Return the truncated distance to the closest obstacle and its x
+            and y derivatives, bilinearly interpolated between the cell
+            centers, at the coordinates xs and ys (arrays of the same shape)
+            as an array of shape xs.shape + (3,).  Coordinates outside of the
+            map are max_distance from every obstacle. """
+        info = self.occupancy_field.map.info
+        height, width = self.table.shape[:2]
+        # the center of the cell (i, j) of the map lives at (j + 1, i + 1)
+        # of the padded table
+        u = ((xs - info.origin.position.x)/info.resolution +
+             0.5).astype(np.float32)
+        v = ((ys - info.origin.position.y)/info.resolution +
+             0.5).astype(np.float32)
+        np.clip(u, 0, width - 1, out=u)
+        np.clip(v, 0, height - 1, out=v)
+        x0 = np.minimum(u.astype(np.intp), width - 2)
+        y0 = np.minimum(v.astype(np.intp), height - 2)
+        fx = (u - x0)[..., np.newaxis]
+        fy = (v - y0)[..., np.newaxis]
+        table = self.table.reshape(-1, 3)
+        index = y0*width + x0
+        values = table.take(index, axis=0)*(1 - fx)
+        values += table.take(index + 1, axis=0)*fx
+        values *= 1 - fy
+        index += width
+        above = table.take(index, axis=0)*(1 - fx)
+        above += table.take(index + 1, axis=0)*fx
+        above *= fy
+        values += above
+        return values
+
+    def _linearize(self, poses, beam_x, beam_y):
+        """ Return the cost (the negative log likelihood of the endpoints
+            beam_x, beam_y) of each of the (3, n) poses, along with its
+            gradient (n, 3) and Gauss-Newton approximation of the Hessian
+            (n, 3, 3) with respect to x, y and theta.  Every endpoint is
+            weighted by the probability that it hit the obstacle it is
+            closest to rather than being random, as in iteratively
+            reweighted least squares. """
+        xs, ys, thetas = poses
+        c = np.cos(thetas)[:, np.newaxis]
+        s = np.sin(thetas)[:, np.newaxis]
+        # the endpoints relative to the pose, rotated into the map frame
+        offset_x = c*beam_x - s*beam_y
+        offset_y = s*beam_x + c*beam_y
+        values = self.lookup(xs[:, np.newaxis] + offset_x,
+                             ys[:, np.newaxis] + offset_y)
+        residuals = values[..., 0]
+        jacobians = np.empty(residuals.shape + (3,))
+        jacobians[..., 0] = values[..., 1]
+        jacobians[..., 1] = values[..., 2]
+        jacobians[..., 2] = values[..., 2]*offset_x - values[..., 1]*offset_y
+        hit = self.z_hit*np.exp(-0.5*(residuals/self.sigma_hit)**2)
+        cost = -np.log(hit + self.z_rand).sum(axis=1)
+        weights = hit/((hit + self.z_rand)*self.sigma_hit**2)
+        weighted = jacobians*weights[..., np.newaxis]
+        gradient = np.matmul(weighted.transpose(0, 2, 1),
+                             residuals[..., np.newaxis])[..., 0]
+        hessian = np.matmul(weighted.transpose(0, 2, 1), jacobians)
+        return cost, gradient, hessian
+
+    def refine_endpoints(self, poses, beam_x, beam_y, iterations=3):
+        """ Return the (3, n) poses after up to iterations Gauss-Newton steps
+            aligning the endpoints beam_x, beam_y (in the robot base frame)
+            with the map, together with the cost of each refined pose.  A
+            step is only taken if it lowers the cost of the pose. """
+        poses = np.array(poses, dtype=np.float64).reshape(3, -1)
+        n = poses.shape[1]
+        if not len(beam_x) or not n:
+            return poses, np.zeros(n)
+        beam_x = np.asarray(beam_x, dtype=np.float64)
+        beam_y = np.asarray(beam_y, dtype=np.float64)
+        cost, gradient, hessian = self._linearize(poses, beam_x, beam_y)
+        damping = self.damping*len(beam_x)/self.sigma_hit**2*np.eye(3)
+        active = np.ones(n, dtype=bool)
+        for _ in range(iterations):
+            steps = -np.linalg.solve(hessian[active] + damping,
+                                     gradient[active][..., np.newaxis])[..., 0]
+            candidates = poses[:, active] + steps.T
+            candidates[2] = wrap_angle(candidates[2])
+            new_cost, new_gradient, new_hessian = self._linearize(
+                candidates, beam_x, beam_y)
+            better = new_cost < cost[active]
+            indices = np.flatnonzero(active)
+            improved = indices[better]
+            poses[:, improved] = candidates[:, better]
+            cost[improved] = new_cost[better]
+            gradient[improved] = new_gradient[better]
+            hessian[improved] = new_hessian[better]
+            # poses that could not be improved have converged
+            active[indices[~better]] = False
+            if not active.any():
+                break
+        return poses, cost
+
+    def refine(self, poses, ranges, angle_min, angle_increment,
+               laser_xy_theta=(0.0, 0.0, 0.0), range_min=0.0,
+               range_max=float('inf'), iterations=3):
+        """ Return the (3, n) poses aligned with a scan and their costs (see
+            refine_endpoints).  The scan arguments are described in
+            LikelihoodFieldModel.log_likelihoods. """
+        beam_x, beam_y = self.scan_endpoints(ranges, angle_min,
+                                             angle_increment, laser_xy_theta,
+                                             range_min, range_max)
+        return self.refine_endpoints(poses, beam_x, beam_y, iterations)
@@ -0,0 +1,76 @@
+""" Planar rigid body transforms (SE(2)) on whole arrays of poses.  A pose is
+    a sequence (x, y, theta) whose elements are scalars or arrays of any
+    broadcastable shape, such as a triple of floats or the (3, n) array of a
+    particle cloud, and every function returns the resulting pose(s) stacked
+    into a single array of shape (3,) + the broadcast shape.  This module has
+    no ROS dependencies. """
+
+import numpy as np
+
+
+def wrap_angle(theta):
+    """ Map the angle(s) theta to the range [-pi, pi] """
+    return np.arctan2(np.sin(theta), np.cos(theta))
+
+
+def angle_diff(a, b):
+    """ Return the signed difference a - b of the angles a and b along the
+        shortest rotation, in [-pi, pi] """
+    return wrap_angle(np.subtract(a, b))
+
+
+def compose(a, b):
+    """ Return the pose(s) b, given relative to the pose(s) a, in the frame a
+        is expressed in (the product a * b) """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    return np.stack(np.broadcast_arrays(a[0] + c*b[0] - s*b[1],
+                                        a[1] + s*b[0] + c*b[1],
+                                        wrap_angle(np.add(a[2], b[2]))))
+
+
+def inverse(a):
+    """ Return the inverse of the pose(s) a, i.e. the pose of the origin
+        relative to a """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    return np.stack(np.broadcast_arrays(-c*a[0] - s*a[1],
+                                        s*a[0] - c*a[1],
+                                        wrap_angle(np.negative(a[2]))))
+
+
+def relative(a, b):
+    """ Return the pose(s) b relative to the pose(s) a (the product
+        inverse(a) * b), which is the motion that takes a to b """
+    c, s = np.cos(a[2]), np.sin(a[2])
+    dx, dy = np.subtract(b[0], a[0]), np.subtract(b[1], a[1])
+    return np.stack(np.broadcast_arrays(c*dx + s*dy,
+                                        -s*dx + c*dy,
+                                        angle_diff(b[2], a[2])))
+
+
+def odometry_motion(old, new):
+    """ Decompose the motion from the pose(s) old to new into an initial
+        rotation, a translation and a final rotation (Probabilistic Robotics,
+        section 5.4).  The initial rotation is 0 wherever the translation is
+        (nearly) zero, so turning in place is a pure final rotation. """
+    dx, dy = np.subtract(new[0], old[0]), np.subtract(new[1], old[1])
+    trans = np.hypot(dx, dy)
+    rot1 = np.where(trans < 1e-6, 0.0,
+                    angle_diff(np.arctan2(dy, dx), old[2]))
+    rot2 = angle_diff(np.subtract(new[2], old[2]), rot1)
+    return rot1, trans, rot2
+
+
+def yaw_from_quaternion(x, y, z, w):
+    """ Return the yaw of the rotation(s) given by the quaternion
+        components x, y, z and w """
+    return np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+
+
+def yaw_quaternions(theta):
+    """ Return a (len(theta), 4) array of the (x, y, z, w) quaternions of
+        rotations by the angles theta about the z axis """
+    half = 0.5*np.asarray(theta, dtype=np.float64)
+    quaternions = np.zeros((half.size, 4))
+    quaternions[:, 2] = np.sin(half)
+    quaternions[:, 3] = np.cos(half)
+    return quaternions
@@ -0,0 +1,8 @@
+""" The nodes import their modules from the scripts directory, so the tests
+    do the same """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'scripts'))
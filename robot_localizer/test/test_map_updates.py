@@ -0,0 +1,59 @@
+""" Tests of repairing the distance field after map edits against
+    rebuilding it from scratch """
+
+import numpy as np
+import pytest
+
+from map_loader import GridMap, MapInfo, Origin
+from occupancy_field import OccupancyField
+from ray_casting import cast_rays
+
+RESOLUTION = 0.05
+SIZE = 400
+
+
+def make_field(grid):
+    info = MapInfo(RESOLUTION, grid.shape[1], grid.shape[0], Origin())
+    return OccupancyField(GridMap(info, grid.ravel().copy()), cache_dir=None)
+
+
+@pytest.fixture
+def field():
+    # a 20 m square room
+    grid = np.zeros((SIZE, SIZE), dtype=np.int8)
+    grid[0] = grid[-1] = grid[:, 0] = grid[:, -1] = 100
+    return make_field(grid)
+
+
+def add_wall(field, radius=2.0):
+    """ Add a wall 3 m in front of (10, 10) and return the field rebuilt
+        from the edited grid """
+    rows = np.arange(1, SIZE - 1)
+    field.update_cells(rows, np.full_like(rows, 260), 100, radius=radius)
+    return make_field(field.grid.copy())
+
+
+def test_repaired_distances_match_a_rebuild(field):
+    rebuilt = add_wall(field)
+    exact = field.closest_occ < 2.0
+    np.testing.assert_allclose(field.closest_occ[exact],
+                               rebuilt.closest_occ[exact])
+    # the others are only known to be at least the radius
+    assert (rebuilt.closest_occ[~exact] >= 2.0 - 1e-6).all()
+    assert field.exact_radius == 2.0
+
+
+def test_rays_stop_at_added_obstacles(field):
+    assert cast_rays(field, 10.0, 10.0, 0.0, 20.0) == \
+        pytest.approx(9.975, abs=RESOLUTION)
+    rebuilt = add_wall(field)
+    assert cast_rays(field, 10.0, 10.0, 0.0, 20.0) == \
+        pytest.approx(3.0, abs=RESOLUTION)
+
+    rng = np.random.default_rng(0)
+    xs = rng.uniform(1.0, 19.0, 500)
+    ys = rng.uniform(1.0, 19.0, 500)
+    thetas = rng.uniform(-np.pi, np.pi, 500)
+    np.testing.assert_allclose(cast_rays(field, xs, ys, thetas, 20.0),
+                               cast_rays(rebuilt, xs, ys, thetas, 20.0),
+                               atol=2*RESOLUTION)
@@ -0,0 +1,51 @@
+""" Tests of the bounds checks of the distance field lookups, in particular
+    at the far (x = width, y = height) edges of the map """
+
+import math
+
+import numpy as np
+import pytest
+
+from map_loader import GridMap, MapInfo, Origin
+from occupancy_field import OccupancyField, lookup_distances
+
+
+@pytest.fixture
+def field():
+    # a 4 x 3 map of 0.5 m cells at (-1, 2) with one obstacle
+    data = np.zeros((3, 4), dtype=np.int8)
+    data[1, 2] = 100
+    info = MapInfo(0.5, 4, 3, Origin(-1.0, 2.0))
+    return OccupancyField(GridMap(info, data.ravel()),
+                          cache_dir=None)
+
+
+def test_distance_inside_the_map(field):
+    assert field.get_closest_obstacle_distance(0.1, 2.6) == 0.0
+    assert field.get_closest_obstacle_distance(-0.9, 2.1) == \
+        pytest.approx(math.hypot(1.0, 0.5))
+
+
+def test_far_edges_are_out_of_bounds(field):
+    # the map covers x in [-1, 1) and y in [2, 3.5)
+    assert math.isnan(field.get_closest_obstacle_distance(1.0, 2.6))
+    assert math.isnan(field.get_closest_obstacle_distance(0.1, 3.5))
+    assert not math.isnan(field.get_closest_obstacle_distance(0.999, 3.499))
+
+
+def test_near_edges_are_in_bounds(field):
+    assert not math.isnan(field.get_closest_obstacle_distance(-1.0, 2.0))
+    assert math.isnan(field.get_closest_obstacle_distance(-1.001, 2.0))
+    assert math.isnan(field.get_closest_obstacle_distance(float('nan'), 2.0))
+
+
+@pytest.mark.parametrize('interpolate', [False, True])
+def test_lookup_distances_at_the_far_edges(field, interpolate):
+    distances = lookup_distances(field.closest_occ, -1.0, 2.0, 0.5,
+                                 [1.0, 0.1, 0.999, -1.001],
+                                 [2.6, 3.5, 3.499, 2.0],
+                                 fill_value=-1.0, interpolate=interpolate)
+    assert distances[0] == -1.0
+    assert distances[1] == -1.0
+    assert distances[2] >= 0.0
+    assert distances[3] == -1.0
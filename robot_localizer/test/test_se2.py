@@ -0,0 +1,81 @@
+""" Tests of the planar transforms in se2.py """
+
+import numpy as np
+import pytest
+
+from se2 import (wrap_angle, angle_diff, compose, inverse, relative,
+                 odometry_motion)
+
+
+@pytest.fixture
+def poses():
+    rng = np.random.default_rng(0)
+    return np.stack((rng.uniform(-5, 5, 50),
+                     rng.uniform(-5, 5, 50),
+                     rng.uniform(-np.pi, np.pi, 50)))
+
+
+def assert_poses_close(a, b):
+    np.testing.assert_allclose(a[:2], b[:2], atol=1e-9)
+    np.testing.assert_allclose(angle_diff(a[2], b[2]), 0.0, atol=1e-9)
+
+
+def test_wrap_angle():
+    np.testing.assert_allclose(wrap_angle([0.0, 3*np.pi/2, -3*np.pi/2,
+                                           5*np.pi, 0.25 - 4*np.pi]),
+                               [0.0, -np.pi/2, np.pi/2, np.pi, 0.25],
+                               atol=1e-12)
+
+
+def test_angle_diff_takes_the_shortest_rotation():
+    assert angle_diff(np.pi - 0.1, -np.pi + 0.1) == pytest.approx(-0.2)
+    assert angle_diff(-np.pi + 0.1, np.pi - 0.1) == pytest.approx(0.2)
+    assert angle_diff(1.0, 0.25) == pytest.approx(0.75)
+
+
+def test_compose():
+    assert_poses_close(compose((1.0, 2.0, np.pi/2), (1.0, 0.0, np.pi)),
+                       np.array([1.0, 3.0, -np.pi/2]))
+
+
+def test_compose_with_inverse_is_identity(poses):
+    assert_poses_close(compose(poses, inverse(poses)), np.zeros_like(poses))
+    assert_poses_close(compose(inverse(poses), poses), np.zeros_like(poses))
+
+
+def test_relative_round_trip(poses):
+    others = poses[:, ::-1]
+    motion = relative(poses, others)
+    assert_poses_close(motion, compose(inverse(poses), others))
+    assert_poses_close(compose(poses, motion), others)
+
+
+def test_relative_broadcasts_a_single_pose(poses):
+    origin = (1.0, -2.0, 0.5)
+    assert relative(origin, poses).shape == poses.shape
+    assert_poses_close(compose(origin, relative(origin, poses)), poses)
+
+
+def test_odometry_motion():
+    rot1, trans, rot2 = odometry_motion((0.0, 0.0, 0.0),
+                                        (1.0, 1.0, np.pi))
+    assert rot1 == pytest.approx(np.pi/4)
+    assert trans == pytest.approx(np.sqrt(2))
+    assert rot2 == pytest.approx(3*np.pi/4)
+
+
+def test_odometry_motion_turning_in_place():
+    rot1, trans, rot2 = odometry_motion((1.0, 2.0, 3.0), (1.0, 2.0, -3.0))
+    assert rot1 == 0.0
+    assert trans == 0.0
+    assert rot2 == pytest.approx(2*np.pi - 6.0)
+
+
+def test_odometry_motion_reconstructs_the_pose(poses):
+    others = poses[:, ::-1]
+    rot1, trans, rot2 = odometry_motion(poses, others)
+    heading = poses[2] + rot1
+    moved = np.stack((poses[0] + trans*np.cos(heading),
+                      poses[1] + trans*np.sin(heading),
+                      heading + rot2))
+    assert_poses_close(moved, others)